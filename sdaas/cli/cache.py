@@ -0,0 +1,118 @@
+"""
+Disk cache of trace features, used to avoid recomputing the features of the
+same waveforms (e.g., when running several times the program with the same
+FDSN URL)
+
+Created on 16 Oct 2026
+
+@author: Riccardo Z. <rizac@gfz-potsdam.de>
+"""
+import os
+import hashlib
+import tempfile
+from os.path import isfile, dirname, abspath
+
+import numpy as np
+
+from sdaas.core.features import FEATURES, traces_features
+
+
+# the process umask, read once (os.umask can only be read by setting it):
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+class FeaturesCache:
+    """Disk cache of trace features. The features are stored in a single
+    compressed numpy file (.npz) and mapped to a key computed from the trace
+    (id, time bounds, sampling rate and data) and the metadata path or URL.
+    The file stores also the features periods (see `FEATURES`): if they
+    changed, the cached features are discarded
+    """
+
+    def __init__(self, path):
+        """Initialize a new cache, loading all features from the given file
+        path, if it exists
+
+        :param path: the cache file path. The extension '.npz' will be
+            appended to the file name, if not already present
+        """
+        if not path.endswith('.npz'):
+            path += '.npz'
+        self._path = abspath(path)
+        self._data = {}
+        self._modified = False
+        if isfile(self._path):
+            with np.load(self._path) as npz:
+                # (caches with no or different FEATURES are discarded):
+                if 'features' in npz.files and \
+                        np.array_equal(npz['features'], FEATURES):
+                    self._data = dict(zip(npz['keys'].tolist(),
+                                          npz['values']))
+
+    @staticmethod
+    def key(trace, metadata_id):
+        """Return the cache key (str) of the given trace
+
+        :param metadata_id: a string uniquely identifying the trace metadata,
+            e.g. the metadata path or URL
+        """
+        stats = trace.stats
+        hash_ = hashlib.blake2b(digest_size=16)
+        hash_.update(f'{trace.get_id()}|{stats.starttime.ns}|{stats.endtime.ns}'
+                     f'|{stats.sampling_rate}|{metadata_id}|'.encode('utf8'))
+        hash_.update(np.ascontiguousarray(trace.data).tobytes())
+        return hash_.hexdigest()
+
+    def traces_features(self, traces, metadata, metadata_id):
+        """Same as :func:`sdaas.core.features.traces_features`, but return
+        the cached features, if found, computing (and caching) only those not
+        found
+
+        :param metadata_id: a string uniquely identifying `metadata`, e.g. the
+            metadata path or URL
+        """
+        traces = list(traces)
+        keys = [self.key(trace, metadata_id) for trace in traces]
+        values = np.full((len(traces), len(FEATURES)), np.nan)
+        missing = []
+        for i, key in enumerate(keys):
+            if key in self._data:
+                values[i] = self._data[key]
+            else:
+                missing.append(i)
+        if missing:
+            values[missing] = traces_features([traces[i] for i in missing],
+                                              metadata)
+            for i in missing:
+                self._data[keys[i]] = values[i]
+            self._modified = True
+        return values
+
+    def save(self):
+        """Write the cache to file, if modified"""
+        if not self._modified:
+            return
+        os.makedirs(dirname(self._path), exist_ok=True)
+        keys = np.array(list(self._data.keys()), dtype=str)
+        # fill a pre-allocated array (np.array(list(...)) would infer
+        # dtype and shape from each element):
+        values = np.empty((len(keys), len(FEATURES)))
+        for i, value in enumerate(self._data.values()):
+            values[i] = value
+        # write to a temporary file and then rename it, so that an
+        # interrupted write does not leave a truncated cache file:
+        fd, tmp_path = tempfile.mkstemp(suffix='.npz.tmp',
+                                        dir=dirname(self._path))
+        try:
+            with os.fdopen(fd, 'wb') as fpt:
+                np.savez_compressed(fpt, keys=keys, values=values,
+                                    features=np.asarray(FEATURES))
+            # mkstemp creates files readable by the owner only. Set the
+            # mode of files created with open() (0o666 minus the umask):
+            os.chmod(tmp_path, 0o666 & ~_UMASK)
+            os.replace(tmp_path, self._path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        self._modified = False
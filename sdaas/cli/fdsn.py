@@ -7,30 +7,72 @@ Created on 10 Sep 2020
 """
 
 import re
-from urllib import parse, request
-from datetime import datetime
+import csv
+import io
+import threading
+from urllib import parse
+from datetime import datetime, timezone
+
+
+# FDSN URL regular expression. Group 1 matches the FDSN service name (either
+# "station" or "dataselect"). URLs are ASCII, so skip Unicode matching rules:
+FDSN_RE = re.compile('\\A[a-zA-Z_]+://.+?/fdsnws/(station|dataselect)/\\d/query?.*',
+                     re.ASCII)
+
+
+def is_fdsn_url(url):
+    """Return True if `url` is a valid station or dataselect FDSN URL"""
+    return FDSN_RE.match(url) is not None
 
 
 def get_station_and_dataselect_urls(url):
     """Return the tuple (station_url, dataselect_url). Raise ValueError
     if `url` is not valid station ort dataselect FDSN URL
     """
-    fdsn_re = '[a-zA-Z_]+://.+?/fdsnws/(?:station|dataselect)/\\d/query?.*'
-    if not re.match(fdsn_re, url):
-        raise ValueError(f'Invalid FDSN URL: {url}')
-    # urlsplit is a namedtuple (scheme, netloc, path, query, fragment). Convert to list
-    # as we need to modify its path (element at index 2):
-    parts = list(parse.urlsplit(url))
-    urls = [url, url]  # station, dataselect
-    if '/dataselect/' in parts[2]:
-        parts[2] = parts[2].replace('/dataselect/', '/station/')
-        urls[0] = parse.urlunsplit(parts)
-    elif '/station/' in parts[2]:
-        parts[2] = parts[2].replace('/station/', '/dataselect/')
-        urls[1] = parse.urlunsplit(parts)
-    else:
+    match = FDSN_RE.match(url)
+    if not match:
         raise ValueError(f'Invalid FDSN URL: {url}')
-    return tuple(urls)
+    # replace the FDSN service name in the URL to get the other URL:
+    start, end = match.span(1)
+    if match.group(1) == 'dataselect':
+        return url[:start] + 'station' + url[end:], url
+    return url, url[:start] + 'dataselect' + url[end:]
+
+
+# HTTP session shared by all requests (see `get_session`):
+_SESSION = None
+
+
+def get_session():
+    """Return the HTTP session (`requests.Session`) to be used for all web
+    requests of this program. The session keeps connections alive and
+    reuses them for subsequent requests to the same host (e.g., several
+    dataselect requests to the same FDSN data center).
+    Thread safe (the session is never created twice)
+    """
+    global _SESSION
+    if _SESSION is None:
+        with _SESSION_LOCK:
+            if _SESSION is None:  # not created while waiting
+                _SESSION = _create_session()
+    return _SESSION
+
+
+_SESSION_LOCK = threading.Lock()
+
+
+def _create_session():
+    """Create and return a new `requests.Session` (see `get_session`)"""
+    # import here (requests is an ObsPy dependency, but relatively slow
+    # to import and not needed when processing local files):
+    import requests
+    from requests.adapters import HTTPAdapter
+    session = requests.Session()
+    # allow up to 16 connections per host (see also run.download_all):
+    adapter = HTTPAdapter(pool_connections=16, pool_maxsize=16)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
 
 
 # default FDSN parameters used in this module (to avoid confusion with multiple names):
@@ -43,6 +85,12 @@ DEFAULT_PARAMS = {
     "end": ('end', 'endtime')
 }
 
+# maps each default param name (any alias) to its default name (dict key):
+_DEFAULT_PARAMS_NAMES = {
+    name: def_param for def_param, names in DEFAULT_PARAMS.items()
+    for name in names
+}
+
 
 def querydict(url, check_dates=True):
     """Return the query string of `url` in form of a dict.
@@ -51,45 +99,86 @@ def querydict(url, check_dates=True):
     :param url: a URL
     :param check_dates: check the validity of start and end params (if given)
     """
-    url_parts = parse.urlsplit(url)
-    # object above is a named tuple:
-    # (scheme, netloc, path, query, fragment)
     try:
         ret = {}
-        # populate dict and check no multiple argument given:
-        for param, values in parse.parse_qs(url_parts.query).items():
-            if len(values) > 1:
-                raise ValueError(f'Multiple values for "{param}"')
-            ret[param] = values[0]
-
-        # check default arguments:
-        for def_param, params in DEFAULT_PARAMS.items():
-            tmp_ret = {p: ret[p] for p in params if p in ret}
-            if len(tmp_ret) > 1:
-                raise ValueError(f'Multiple values for "{"/".join(params)}"')
-            elif len(tmp_ret) == 1 and next(iter(tmp_ret)) != def_param:
-                ret[def_param] = ret.pop(next(iter(tmp_ret)))
+        # populate dict (renaming default params to their default name) and
+        # check no multiple argument given. Note: the query string parsing is
+        # the same as `parse.parse_qs(parse.urlsplit(url).query)` (blank values
+        # skipped, "+" and %-escapes decoded) but faster:
+        for param, value in _split_query(url):
+            param = _DEFAULT_PARAMS_NAMES.get(param, param)
+            if param in ret:
+                names = DEFAULT_PARAMS.get(param, (param,))
+                raise ValueError(f'Multiple values for "{"/".join(names)}"')
+            ret[param] = value
 
         if check_dates:
+            dtimes = {}  # param -> parsed datetime (parse each param once)
             for param in ('start', 'end'):
                 if param in ret:
                     try:
                         # check datetime (just a check, keep str as value)
-                        datetime.fromisoformat(ret[param])
+                        dtimes[param] = parse_datetime(ret[param])
                     except (ValueError, TypeError):
-                        raise ValueError(f'Invalid date-time for "{param}"')
-            if 'start' in ret:
-                end = ret.get('end', datetime.utcnow().isoformat())
-                if datetime.fromisoformat(ret['start']) >= datetime.fromisoformat(end):
+                        raise ValueError(f'Invalid date-time for "{param}"') \
+                            from None
+            if 'start' in dtimes:
+                end = dtimes.get('end', None) or utcnow()
+                if dtimes['start'] >= end:
                     raise ValueError('Invalid date-time range: decrease start '
                                      'or increase end (if provided)')
 
     except (KeyError, ValueError) as exc:
-        raise ValueError(f'{str(exc)}. URL: {url}')
+        raise ValueError(f'{str(exc)}. URL: {url}') from None
 
     return ret
 
 
+def _split_query(url):
+    """Yield the (param, value) pairs of the query string of `url`, skipping
+    blank values
+    """
+    query = _split_url(url)[1]
+    if not query:
+        return
+    # FDSN queries usually have no escaped chars: check the whole query first
+    # to skip the per-param check below:
+    unquote = '%' in query or '+' in query
+    for token in query.split('&'):
+        param, _, value = token.partition('=')
+        if not value:
+            continue
+        if not unquote:
+            yield param, value
+            continue
+        if '%' in param or '+' in param:
+            param = parse.unquote_plus(param)
+        if '%' in value or '+' in value:
+            value = parse.unquote_plus(value)
+        yield param, value
+
+
+def parse_datetime(value):
+    """Parse the given date-time string in ISO format (e.g. "2019-06-01" or
+    "2019-06-01T01:02:03.500") into a naive `datetime` object. A trailing
+    "Z" (UTC), common in FDSN date-times, is allowed and ignored. Raise
+    ValueError or TypeError if `value` can not be parsed
+    """
+    # datetime.fromisoformat is implemented in C (fast) but does not accept
+    # "Z" before Python 3.11, and after that returns a timezone aware
+    # datetime (not comparable with our naive UTC datetimes). Strip "Z" first:
+    if value[-1:] in ('Z', 'z'):
+        value = value[:-1]
+    return datetime.fromisoformat(value)
+
+
+def utcnow():
+    """Return the current UTC date-time as naive `datetime` (same as the
+    deprecated `datetime.utcnow()`)
+    """
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
 def get_dataselect_urls(url, timeout=None):
     """Get all dataselect URLs from the given FDSN station url
 
@@ -104,24 +193,38 @@ def get_dataselect_urls(url, timeout=None):
     params = querydict(url)
     params['level'] = 'station'
     params['format'] = 'text'
-    req = request.Request(build_url(url, **params))
-    with request.urlopen(req, timeout=timeout) as response:
-        the_page = response.read().strip().decode('utf-8')
+    response = get_session().get(build_url(url, **params), timeout=timeout)
+    response.raise_for_status()
+    the_page = response.content.strip().decode('utf-8')
+    return _get_dataselect_urls(fdsn_dataselect_url, params, the_page)
+
+
+def _get_dataselect_urls(fdsn_dataselect_url, params, station_text):
+    """Return the list of dataselect URLs, one for each station in
+    `station_text` (FDSN station text response, level=station)
+
+    :param fdsn_dataselect_url: the FDSN dataselect base URL
+    :param params: the query parameters of the station URL
+    :param station_text: the station text response (str)
+    """
     urls = []
-    if not the_page:
+    if not station_text:
         return urls
-    now = datetime.utcnow().isoformat()
-    for line in the_page.split('\n'):
-        if '#' in line:
+    now = utcnow().isoformat()
+    common_args = {p: v for p, v in params.items() if p in DEFAULT_PARAMS}
+    # tokenize with the csv module (faster). No quoting: '"' is a valid char
+    # in the FDSN text (e.g., site names):
+    for cells in csv.reader(io.StringIO(station_text), delimiter='|',
+                            quoting=csv.QUOTE_NONE):
+        if not cells or cells[0].lstrip().startswith('#'):  # empty or header
             continue
-        cells = [_.strip() for _ in line.split('|')]
         args = {
-            **{p: v for p, v in params.items() if p in DEFAULT_PARAMS},
-            'net': cells[0],
-            'sta': cells[1]
+            **common_args,
+            'net': cells[0].strip(),
+            'sta': cells[1].strip()
         }
-        args.setdefault('start', cells[-2])
-        args.setdefault('end', cells[-1] or now)
+        args.setdefault('start', cells[-2].strip())
+        args.setdefault('end', cells[-1].strip() or now)
         urls.append(build_url(fdsn_dataselect_url, **args))
     return urls
 
@@ -136,13 +239,32 @@ def build_url(url, **queryparams):
 
     :return a string denoting the url build from the given queryparams
     """
-    url_parts = list(parse.urlsplit(url))
-    # object above is a named tuple:
-    # (scheme, netloc, path, query, fragment)
-    url_parts[3] =[]
-    for k, v in queryparams.items():
-        if isinstance(v, datetime):
-            v = v.isoformat()
-        url_parts[3].append(f'{k}={v}')
-    url_parts[3] = '&'.join(url_parts[3])
-    return parse.urlunsplit(url_parts)
+    base, _, fragment = _split_url(url)
+    # Build the query string percent-encoding values, if needed (same as
+    # `parse.urlencode` but faster):
+    query = '&'.join(f'{_quote(p)}={_quote(v)}' for p, v in queryparams.items())
+    return f'{base}?{query}{fragment}' if query else base + fragment
+
+
+def _quote(value):
+    """Convert `value` to str and percent-encode it for a URL query string,
+    keeping FDSN wildcards, time and list separators unquoted for readability
+    """
+    if isinstance(value, datetime):
+        value = value.isoformat()
+    return parse.quote_plus(str(value), safe='*?:,')
+
+
+def _split_url(url):
+    """Split `url` into the tuple of strings `(base, query, fragment)`, where
+    `base` is the URL up to the query string (excluded), `query` is the query
+    string without the leading "?" and `fragment` is the fragment (including
+    the leading "#"). Missing parts are returned as empty strings
+    """
+    end = url.find('#')  # fragment start, if any
+    if end < 0:
+        end = len(url)
+    start = url.find('?', 0, end)
+    if start < 0:
+        return url[:end], '', url[end:]
+    return url[:start], url[start + 1: end], url[end:]
@@ -7,10 +7,9 @@ Created on 10 Sep 2020
 """
 import os
 import sys
-from datetime import datetime
+import time
 from contextlib import contextmanager
-import math
-import shutil
+from functools import lru_cache
 from typing import TextIO
 
 
@@ -44,8 +43,17 @@ class ansi_colors_escape_codes:
         and False otherwise. Copied from:
         https://github.com/django/django/blob/master/django/core/management/color.py#L12
         """
-        supported_platform = sys.platform != 'win32' or 'ANSICON' in os.environ
-        return supported_platform and isatty(sys.stdout)
+        # (sys.stdout might be replaced at runtime, so pass it as cache key):
+        return _ansi_colors_supported(sys.stdout)
+
+
+@lru_cache(maxsize=8)
+def _ansi_colors_supported(stream):
+    """Return True if the given stream supports ANSI colors. The result is
+    cached, as this function is called for every printed line
+    """
+    supported_platform = sys.platform != 'win32' or 'ANSICON' in os.environ
+    return supported_platform and isatty(stream)
 
 
 @contextmanager
@@ -84,32 +92,34 @@ def redirect(src=None, dst=os.devnull):
     # descriptor:
     # assert libc.fileno(ctypes.c_void_p.in_dll(libc, "stdout")) == file_desc == 1
 
-    def _redirect_stderr_to(fileobject):
-        sys.stderr.close()  # + implicit flush()
-        # make `file_desc` point to the same file as `fileobject`.
-        # First closes file_desc if necessary:
-        os.dup2(fileobject.fileno(), file_desc)
-        # Make Python write to file_desc
-        sys.stderr = os.fdopen(file_desc, 'w')
-
-    def _redirect_stdout_to(fileobject):
-        sys.stdout.close()  # + implicit flush()
-        # make `file_desc` point to the same file as `fileobject`.
-        # First closes file_desc if necessary:
-        os.dup2(fileobject.fileno(), file_desc)
-        # Make Python write to file_desc
-        sys.stdout = os.fdopen(file_desc, 'w')
-
-    _redirect_to = _redirect_stderr_to if src is sys.stderr else _redirect_stdout_to
-
-    with os.fdopen(os.dup(file_desc), 'w') as src_fileobject:
-        with open(dst, 'w') as dst_fileobject:
-            _redirect_to(dst_fileobject)
-        try:
-            yield  # allow code to be run with the redirected stdout/err
-        finally:
-            # restore stdout/err. buffering and flags such as CLOEXEC may be different:
-            _redirect_to(src_fileobject)
+    # Make `file_desc` point to the same file as `dst` with `os.dup2` (this
+    # redirects both Python and C output, as they both write to `file_desc`).
+    # Flush Python buffered output before redirecting and before restoring:
+    src.flush()
+    saved_file_desc = os.dup(file_desc)
+    dst_file_desc = _get_devnull_fd() if dst == os.devnull else \
+        os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+    try:
+        os.dup2(dst_file_desc, file_desc)
+        if dst_file_desc != _DEVNULL_FD:
+            os.close(dst_file_desc)
+        yield  # allow code to be run with the redirected stdout/err
+    finally:
+        # restore stdout/err:
+        src.flush()
+        os.dup2(saved_file_desc, file_desc)
+        os.close(saved_file_desc)
+
+
+# file descriptor of os.devnull, opened once and reused (see `redirect`):
+_DEVNULL_FD = None
+
+
+def _get_devnull_fd():
+    global _DEVNULL_FD
+    if _DEVNULL_FD is None:
+        _DEVNULL_FD = os.open(os.devnull, os.O_WRONLY)
+    return _DEVNULL_FD
 
 
 class ProgressBar:
@@ -118,6 +128,11 @@ class ProgressBar:
     # Code modified from:
     # https://mike42.me/blog/2018-06-make-better-cli-progress-bars-with-unicode-block-characters
 
+    # min. time (in seconds) between two terminal width queries:
+    WIDTH_REFRESH_INTERVAL = 0.2
+    # min. time (in seconds) between two redraws (the final one excluded):
+    MIN_REDRAW_INTERVAL = 0.05
+
     def __init__(self, target: TextIO or None = sys.stderr,
                  show_percent=True, show_eta=True):
         self._target = target
@@ -126,10 +141,15 @@ class ProgressBar:
         self._show_eta = show_eta
         self._start = None
         self._lpad, self._rpad = '[', ']'  # pbar paddings (left and right)
+        # terminal width and the time it was queried (see `set_progress`):
+        self._width, self._width_time = None, None
+        self._last_draw_time = None  # time of the last redraw
 
     def __enter__(self):
         if self._show_eta:
-            self._start = datetime.utcnow()
+            # use a monotonic clock (faster, and unaffected by system clock
+            # changes):
+            self._start = time.monotonic()
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
@@ -147,8 +167,22 @@ class ProgressBar:
         """0 <= progress <= 1 """
         if not self._target:
             return
-        # Update width in case of resize
-        width, _ = shutil.get_terminal_size((80, 20))
+        now = time.monotonic()
+        # Do not redraw too often (writing to, and flushing, the terminal is
+        # relatively expensive), but always draw the completed progress:
+        if progress < 1 and self._last_draw_time is not None and \
+                now - self._last_draw_time < self.MIN_REDRAW_INTERVAL:
+            return
+        self._last_draw_time = now
+        # Update width in case of resize. Querying the terminal size is a
+        # system call, so do it at most every `self.WIDTH_REFRESH_INTERVAL`
+        # seconds:
+        if self._width is None or \
+                now - self._width_time >= self.WIDTH_REFRESH_INTERVAL:
+            import shutil  # lazy import (not needed if no pbar is shown)
+            self._width, _ = shutil.get_terminal_size((80, 20))
+            self._width_time = now
+        width = self._width
         # on our terminal, it is visually nicer to leave the last char
         # empty as it is filled with a square semi-opaque cursor
         # let's leave the last char empty (this has no bad visual effect and
@@ -169,20 +203,16 @@ class ProgressBar:
         # Progress bar itself
         eta_str, eta_width = '', 13  # <- length of eta string
         if self._show_eta and width >= eta_width + min_pbar_width:
-            eta = (1-progress) * \
-                (datetime.utcnow() - self._start) / progress
-            sec = round(eta.total_seconds() + 1e-7)
+            eta = (1-progress) * (now - self._start) / progress
+            sec = round(eta + 1e-7)
             # 1e-7 because python 3 rounds down 0.5, and we want it up. See
             # https://stackoverflow.com/questions/10825926/python-3-x-rounding-behavior
-            day = int(sec / (3600 * 24))
-            sec -= day * (3600 * 24)
+            day, sec = divmod(max(0, sec), 3600 * 24)
             if day >= 100:
                 eta_str = f'>={str(day)}d'.rjust(eta_width)
             else:
-                hrs = int(sec / 3600)
-                sec -= hrs * 3600
-                mnt = int(sec / 60)
-                sec -= mnt * 60
+                hrs, sec = divmod(sec, 3600)
+                mnt, sec = divmod(sec, 60)
                 eta_str = f' {day:>2}d {hrs:02}:{mnt:02}:{sec:02}'
             width -= eta_width
 
@@ -193,23 +223,29 @@ class ProgressBar:
 
         pbar_str = ProgressBar.progress_bar_str(progress, width)
 
-        # Write output
-        pbar_str = f'{lpad}{pbar_str}{rpad}{percent_str}{eta_str}'
+        # Write output (build the whole line with a single string formatting):
         if self._text_only:
-            self._target.write(pbar_str + '\n')
+            prefix, suffix = '', '\n'
         else:
-            self._target.write('\033[G' + pbar_str)
-        self._target.flush()
+            prefix, suffix = '\033[G', ''
+        self._target.write(f'{prefix}{lpad}{pbar_str}{rpad}{percent_str}'
+                           f'{eta_str}{suffix}')
+        if not self._text_only:
+            # (text only output is not interactive: let the stream buffer
+            # the lines. All content is flushed on exit anyway)
+            self._target.flush()
 
     @staticmethod
     def progress_bar_str(progress: float, width: int):
         # 0 <= progress <= 1
-        progress = min(1, max(0, progress))
-        whole_width = math.floor(progress * width)
-        remainder_width = (progress * width) % 1
-        part_width = math.floor(remainder_width * 8)
-        part_char = [" ", "▏", "▎", "▍", "▌", "▋", "▊", "▉"][part_width]
+        progress = min(1, max(0, progress)) * width
+        whole_width = int(progress)  # = math.floor(progress), as progress >= 0
+        part_char = _PBAR_PART_CHARS[int((progress - whole_width) * 8)]
         if (width - whole_width - 1) < 0:
             part_char = ""
         line = "█" * whole_width + part_char + " " * (width - whole_width - 1)
         return line
+
+
+# the progress bar chars representing the fractional part of the progress:
+_PBAR_PART_CHARS = (" ", "▏", "▎", "▍", "▌", "▋", "▊", "▉")
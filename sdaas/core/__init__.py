@@ -1,13 +1,51 @@
-from .model import (aa_scores,
-                    trace_score,
-                    traces_scores,
-                    traces_idscores,
-                    streams_scores,
-                    streams_idscores)
-from .psd import psd, trace_psd
-from .features import (trace_features,
-                       trace_idfeatures,
-                       traces_features,
-                       traces_idfeatures,
-                       streams_features,
-                       streams_idfeatures)
+from importlib import import_module
+
+# Import the psd functions eagerly: the name `psd` is also the name of the
+# submodule, and a lazy import would return the latter if the submodule was
+# already imported. The psd module is needed by all other modules anyway:
+from .psd import psd, trace_psd, traces_psd
+
+# public names mapped to the module defining them. Modules are imported lazily
+# (PEP 562) on first access, so that e.g. importing `sdaas.core.psd` or
+# `sdaas.core.features` does not also import the model module:
+_LAZY_ATTRS = {
+    **{name: 'sdaas.core.model' for name in ('aa_scores',
+                                             'trace_score',
+                                             'traces_scores',
+                                             'traces_idscores',
+                                             'streams_scores',
+                                             'streams_idscores',
+                                             'iter_streams_idscores')},
+    **{name: 'sdaas.core.features' for name in ('trace_features',
+                                                'trace_idfeatures',
+                                                'traces_features',
+                                                'traces_idfeatures',
+                                                'streams_features',
+                                                'streams_idfeatures',
+                                                'iter_streams_idfeatures',
+                                                'traces_ids')}
+}
+
+__all__ = ['psd', 'trace_psd', 'traces_psd', *_LAZY_ATTRS]
+
+# submodules accessible as attributes (e.g. `sdaas.core.model`), imported
+# lazily as the attributes above:
+_LAZY_SUBMODULES = ('model', 'features')
+
+
+def __getattr__(name):
+    if name in _LAZY_SUBMODULES:
+        # (importing a submodule also sets it as attribute of this package):
+        return import_module(f'{__name__}.{name}')
+    try:
+        module_name = _LAZY_ATTRS[name]
+    except KeyError:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}") \
+            from None
+    value = getattr(import_module(module_name), name)
+    globals()[name] = value  # cache (next access will not call this function)
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__) | set(_LAZY_SUBMODULES))
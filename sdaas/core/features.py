@@ -10,14 +10,29 @@ Created on 18 Jun 2020
 
 @author: Riccardo Z. <rizac@gfz-potsdam.de>
 """
+from collections import namedtuple
+from functools import lru_cache
+from itertools import chain, islice
+
 import numpy as np
+from obspy.core.utcdatetime import UTCDateTime
 
-from sdaas.core.psd import trace_psd
+from sdaas.core.psd import trace_psd, traces_psd
 
 
 PSD_PERIODS_SEC = (5.,)  # use floats for safety (numpy cast errors?)
 FEATURES = tuple(PSD_PERIODS_SEC)
 
+# FEATURES as numpy array, passed to the psd functions to avoid converting
+# the tuple at each call (read-only, as it is shared):
+_FEATURES_PERIODS = np.array(FEATURES, dtype=float)
+_FEATURES_PERIODS.setflags(write=False)
+
+# empty features array (read-only, as it is shared. Do not return it from
+# public functions, return a copy instead. See `featappend_many`):
+_EMPTY_FEATURES = np.empty((0, len(FEATURES)), dtype=float)
+_EMPTY_FEATURES.setflags(write=False)
+
 
 def _get_id(trace):
     """Returns the default id from a given trace"""
@@ -26,11 +41,56 @@ def _get_id(trace):
     # we choose here to provide standard Python classes (potentially loosing
     # nanosecond precision though) which seem to be also more lightweight
     # (almost half of the size, from tests)
-    return (trace.get_id(), trace.stats.starttime.datetime,
-            trace.stats.endtime.datetime)
+    stats = trace.stats
+    # UTCDateTime.ns is a fast int attribute: use it to get the (cached) id:
+    return _get_id_from_ns(trace.get_id(), stats.starttime.ns,
+                           stats.endtime.ns)
+
+
+@lru_cache(maxsize=1024)
+def _get_id_from_ns(seed_id, start_ns, end_ns):
+    """Return the tuple (seed_id, start, end) with start and end converted
+    from nanoseconds to datetime. The result is cached, as the conversion to
+    datetime is relatively slow and the same trace might be identified
+    several times
+    """
+    return (seed_id, UTCDateTime(ns=start_ns).datetime,
+            UTCDateTime(ns=end_ns).datetime)
+
+
+TracesIds = namedtuple('TracesIds', ['seed_ids', 'starts', 'ends'])
 
 
-def streams_features(streams, metadata):
+def traces_ids(traces):
+    """Return the identifiers of all traces as "structure of arrays", i.e.
+    as three parallel numpy arrays instead of a list of tuples (see
+    :func:`traces_idfeatures`). This is useful for vectorized filtering,
+    sorting or grouping, e.g.: `ids.seed_ids[ids.starts > t0]`
+
+    :param traces: an iterable of
+        `Trace <https://docs.obspy.org/packages/autogen/obspy.core.trace.Trace.html>_`
+        including also the
+        `Stream object<https://docs.obspy.org/packages/autogen/obspy.core.stream.Stream.html>_`
+
+    :return: the namedtuple `(seed_ids, starts, ends)` of three numpy arrays
+        of length N, where N is the number of traces: the traces channel seed
+        ids (dtype object), start times and end times (dtype datetime64[ns],
+        no precision loss)
+    """
+    traces = list(traces)
+    seed_ids = np.empty(len(traces), dtype=object)
+    starts = np.empty(len(traces), dtype=np.int64)
+    ends = np.empty(len(traces), dtype=np.int64)
+    for i, trace in enumerate(traces):
+        stats = trace.stats
+        seed_ids[i] = trace.get_id()
+        starts[i] = stats.starttime.ns
+        ends[i] = stats.endtime.ns
+    return TracesIds(seed_ids, starts.view('datetime64[ns]'),
+                     ends.view('datetime64[ns]'))
+
+
+def streams_features(streams, metadata, n_jobs=1, dtype=float):
     """Compute the features of all
     `Traces <https://docs.obspy.org/packages/autogen/obspy.core.trace.Trace.html>_`
      in `streams`
@@ -39,20 +99,23 @@ def streams_features(streams, metadata):
         `Streams <https://docs.obspy.org/packages/autogen/obspy.core.stream.Stream.html>_`
     :param metadata: the streams metadata as
         `Inventory <https://docs.obspy.org/packages/obspy.core.inventory.html>_`
+    :param n_jobs: the number of threads used (-1: as many as the CPUs).
+        See :func:`sdaas.core.psd.traces_psd`
+    :param dtype: the float dtype of the computation and of the returned
+        features (default: float64). `numpy.float32` is faster but less
+        precise. See :func:`sdaas.core.psd.traces_psd`
 
     :return: a N X 1 numpy array of floats representing the N one-dimensional
         feature vectors, where N is the total number of processed traces
 
     .. seealso:: :func:`trace_features`
     """
-    values = []
-    for stream in streams:
-        for trace in stream:
-            values.append(trace_features(trace, metadata))
-    return np.array(values)
+    return traces_features(chain.from_iterable(streams), metadata, n_jobs,
+                           dtype)
 
 
-def streams_idfeatures(streams, metadata, idfunc=_get_id):
+def streams_idfeatures(streams, metadata, idfunc=_get_id, n_jobs=1,
+                       dtype=float):
     """Compute the features of all
     `Traces<https://docs.obspy.org/packages/autogen/obspy.core.trace.Trace.html>_`
     in `streams` returning also the traces identifiers
@@ -64,6 +127,11 @@ def streams_idfeatures(streams, metadata, idfunc=_get_id):
     :param idfunc: the (optional) function `f(trace)` used to get the trace id.
         When None or missing, each trace id will be computed as the tuple
         `(trace_channel_seedID:str, trace_start:datetime, trace_end:datetime)`
+    :param n_jobs: the number of threads used (-1: as many as the CPUs).
+        See :func:`sdaas.core.psd.traces_psd`
+    :param dtype: the float dtype of the computation and of the returned
+        features (default: float64). `numpy.float32` is faster but less
+        precise. See :func:`sdaas.core.psd.traces_psd`
 
     :return: the tuple `(ids, features)` where, called N the processed traces
         number, ids is a list N identifiers and features is a N X 1 numpy array
@@ -71,16 +139,32 @@ def streams_idfeatures(streams, metadata, idfunc=_get_id):
 
     .. seealso:: :func:`trace_idfeatures`
     """
-    values, ids = [], []
-    for stream in streams:
-        for trace in stream:
-            id_, val = trace_idfeatures(trace, metadata, idfunc)
-            ids.append(id_)
-            values.append(val)
-    return ids, np.array(values)
+    return traces_idfeatures(chain.from_iterable(streams), metadata, idfunc,
+                             n_jobs, dtype)
+
+
+def iter_streams_idfeatures(streams, metadata, idfunc=_get_id,
+                            chunk_size=1024, n_jobs=1, dtype=float):
+    """Same as :func:`streams_idfeatures` but computes the features in chunks
+    of at most `chunk_size` traces, yielding each chunk as soon as computed.
+    Useful for processing large datasets, as the consumer (e.g. writing to
+    file) does not need to hold all ids and features in memory
+
+    :param chunk_size: the maximum number of traces processed at once
+    For all other parameters, see :func:`streams_idfeatures`
+
+    :return: a generator yielding the tuples `(ids, features)` of each chunk.
+        See :func:`streams_idfeatures` for details
+    """
+    traces = chain.from_iterable(streams)
+    while True:
+        chunk = list(islice(traces, chunk_size))
+        if not chunk:
+            return
+        yield traces_idfeatures(chunk, metadata, idfunc, n_jobs, dtype)
 
 
-def traces_features(traces, metadata):
+def traces_features(traces, metadata, n_jobs=1, dtype=float):
     """Compute the features of all traces
 
     :param traces: an iterable of
@@ -89,19 +173,25 @@ def traces_features(traces, metadata):
         `Stream object<https://docs.obspy.org/packages/autogen/obspy.core.stream.Stream.html>_`
     :param metadata: the streams metadata as
         `Inventory <https://docs.obspy.org/packages/obspy.core.inventory.html>_`
+    :param n_jobs: the number of threads used (-1: as many as the CPUs).
+        See :func:`sdaas.core.psd.traces_psd`
+    :param dtype: the float dtype of the computation and of the returned
+        features (default: float64). `numpy.float32` is faster but less
+        precise. See :func:`sdaas.core.psd.traces_psd`
 
     :return: a N X 1 numpy array of floats representing the N one-dimensional
         feature vectors, where N is the total number of processed Traces
 
     .. seealso:: :func:`trace_features`
     """
-    values = []
-    for trace in traces:
-        values.append(trace_features(trace, metadata))
-    return np.array(values)
+    # traces are processed in batches (see `traces_psd`), which is faster than
+    # calling `trace_features` on each trace:
+    return traces_psd(traces, metadata, _FEATURES_PERIODS, n_jobs=n_jobs,
+                      dtype=dtype)
 
 
-def traces_idfeatures(traces, metadata, idfunc=_get_id):
+def traces_idfeatures(traces, metadata, idfunc=_get_id, n_jobs=1,
+                      dtype=float):
     """Compute the features of all traces and their identifiers
 
     :param traces: an iterable of
@@ -113,6 +203,11 @@ def traces_idfeatures(traces, metadata, idfunc=_get_id):
     :param idfunc: the (optional) function `f(trace)` used to get the trace id.
         When None or missing, each trace id will be computed as the tuple
         `(trace_channel_seedID:str, trace_start:datetime, trace_end:datetime)`
+    :param n_jobs: the number of threads used (-1: as many as the CPUs).
+        See :func:`sdaas.core.psd.traces_psd`
+    :param dtype: the float dtype of the computation and of the returned
+        features (default: float64). `numpy.float32` is faster but less
+        precise. See :func:`sdaas.core.psd.traces_psd`
 
     :return: the tuple `(ids, features)` where, called N the processed traces
         number, ids is a list N identifiers and features is a N X 1 numpy array
@@ -120,15 +215,13 @@ def traces_idfeatures(traces, metadata, idfunc=_get_id):
 
     .. seealso:: :func:`trace_idfeatures`
     """
-    values, ids = [], []
-    for trace in traces:
-        id_, val = trace_idfeatures(trace, metadata, idfunc)
-        ids.append(id_)
-        values.append(val)
-    return ids, np.array(values)
+    traces = list(traces)
+    ids = [idfunc(trace) for trace in traces]
+    return ids, traces_psd(traces, metadata, _FEATURES_PERIODS, n_jobs=n_jobs,
+                           dtype=dtype)
 
 
-def trace_features(trace, metadata):
+def trace_features(trace, metadata, dtype=float):
     """Compute the features of the given trace.
     Note that the outcome of the Feature selection employed for identifying the
     best combination of features resulted in a single feature among all PSD
@@ -141,10 +234,14 @@ def trace_features(trace, metadata):
     :param metadata: the streams metadata as
         `Inventory <https://docs.obspy.org/packages/obspy.core.inventory.html>_`
 
+    :param dtype: the float dtype of the computation and of the returned
+        features (default: float64). `numpy.float32` is faster but less
+        precise. See :func:`sdaas.core.psd.trace_psd`
+
     :return: a 1-length numpy float array of shape (1,) representing the trace
         features vector
     """
-    return trace_psd(trace, metadata, FEATURES)[0]
+    return trace_psd(trace, metadata, _FEATURES_PERIODS, dtype=dtype)[0]
 
 
 def trace_idfeatures(trace, metadata, idfunc=_get_id):
@@ -166,12 +263,13 @@ def trace_idfeatures(trace, metadata, idfunc=_get_id):
     :return: the tuple `(id, features)` where id is the trace id and features
         is a numpy array of length 1 representing the trace features vector
     """
-    return idfunc(trace), trace_psd(trace, metadata, FEATURES)[0]
+    return idfunc(trace), trace_features(trace, metadata)
 
 
 def featappend(features1, features2):
     """Call `numpy.append(features1, features2)`. This method works also if one
-    inputs Nones or empty array.
+    inputs Nones or empty array. To concatenate more than two arrays, collect
+    them in a list and call :func:`featappend_many` once (faster)
 
     .. seealso:: :func:`traces_features` or :func:`streams_features`
 
@@ -182,11 +280,22 @@ def featappend(features1, features2):
 
     :return features1 + features2 in a single (N + M) x 1 array
     """
-    flen = len(FEATURES)
+    return featappend_many((features1, features2))
+
+
+def featappend_many(features):
+    """Concatenate all given features arrays with a single copy. Nones or empty
+    arrays are also valid and skipped.
 
-    if features1 is None or not len(features1):
-        features1 = np.full(shape=(0, flen), fill_value=np.nan)
-    if features2 is None or not len(features2):
-        features2 = np.full(shape=(0, flen), fill_value=np.nan)
+    .. seealso:: :func:`featappend`
 
-    return np.append(features1, features2, axis=0)
+    :param features: an iterable of Nx1 arrays of features, e.g. the outputs
+        of :func:`traces_features` or :func:`streams_features`
+
+    :return all features concatenated in a single (N1 + N2 + ...) x 1 array
+        (a new array, also when all inputs are empty)
+    """
+    features = [f for f in features if f is not None and len(f)]
+    if not features:
+        return _EMPTY_FEATURES.copy()  # (callers might modify the array)
+    return np.concatenate(features, axis=0)
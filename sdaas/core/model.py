@@ -13,17 +13,22 @@ Created on 18 Jun 2020
 
 @author: Riccardo Z. <rizac@gfz-potsdam.de>
 """
+import os
+import threading
 from os.path import join, dirname
+from importlib.util import find_spec
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 # from sklearn.ensemble.iforest import IsolationForest
 
 from sdaas.core.features import (FEATURES, _get_id, traces_idfeatures,
                                  traces_features, streams_idfeatures,
-                                 streams_features, trace_features)
+                                 streams_features, trace_features,
+                                 iter_streams_idfeatures)
 
 
-def streams_idscores(streams, metadata, idfunc=_get_id):
+def streams_idscores(streams, metadata, idfunc=_get_id, n_jobs=1):
     """Compute the amplitude anomaly score in [0, 1] from the
     `Traces <https://docs.obspy.org/packages/autogen/obspy.core.trace.Trace.html>_`
     in `streams`, and their identifiers. For details, see :func:`aa_scores`
@@ -35,6 +40,9 @@ def streams_idscores(streams, metadata, idfunc=_get_id):
     :param idfunc: the (optional) function `f(trace)` used to get the trace id.
         When None or missing, each trace id will be computed as the tuple
         `(trace_channel_seedID:str, trace_start:datetime, trace_end:datetime)`
+    :param n_jobs: the number of threads used to compute the features and
+        the scores (-1: as many as the CPUs). See
+        :func:`sdaas.core.psd.traces_psd` and :func:`aa_scores`
 
     :return: the tuple `(ids, scores)` where, called N the processed traces
         number, `ids` is a list N identifiers and scores is a numpy array of N
@@ -42,11 +50,29 @@ def streams_idscores(streams, metadata, idfunc=_get_id):
 
     .. seealso:: :func:`aa_scores`
     """
-    ids, feats = streams_idfeatures(streams, metadata, idfunc)
-    return ids, aa_scores(feats, check_nan=True)
+    ids, feats = streams_idfeatures(streams, metadata, idfunc, n_jobs)
+    return ids, aa_scores(feats, check_nan=True, n_jobs=n_jobs)
 
 
-def streams_scores(streams, metadata):
+def iter_streams_idscores(streams, metadata, idfunc=_get_id, chunk_size=1024,
+                          n_jobs=1):
+    """Same as :func:`streams_idscores` but computes the scores in chunks of
+    at most `chunk_size` traces, yielding each chunk as soon as computed.
+    Useful for processing large datasets, as the consumer (e.g. writing to
+    file) does not need to hold all ids, features and scores in memory
+
+    :param chunk_size: the maximum number of traces processed at once
+    For all other parameters, see :func:`streams_idscores`
+
+    :return: a generator yielding the tuples `(ids, scores)` of each chunk.
+        See :func:`streams_idscores` for details
+    """
+    for ids, feats in iter_streams_idfeatures(streams, metadata, idfunc,
+                                              chunk_size, n_jobs):
+        yield ids, aa_scores(feats, check_nan=True, n_jobs=n_jobs)
+
+
+def streams_scores(streams, metadata, n_jobs=1):
     """Compute the amplitude anomaly score in [0, 1] from the given Streams.
     For details, see :func:`aa_scores`
 
@@ -54,17 +80,20 @@ def streams_scores(streams, metadata):
         `Streams<https://docs.obspy.org/packages/autogen/obspy.core.stream.Stream.html>_`
     :param metadata: the Streams metadata as
         `Inventory <https://docs.obspy.org/packages/obspy.core.inventory.html>_`
+    :param n_jobs: the number of threads used to compute the features and
+        the scores (-1: as many as the CPUs). See
+        :func:`sdaas.core.psd.traces_psd` and :func:`aa_scores`
 
     :return: a numpy array of N floats in [0, 1], or numpy.nan (if score could
         not be computed)
 
     .. seealso:: :func:`aa_scores`
     """
-    feats = streams_features(streams, metadata)
-    return aa_scores(feats, check_nan=True)
+    feats = streams_features(streams, metadata, n_jobs)
+    return aa_scores(feats, check_nan=True, n_jobs=n_jobs)
 
 
-def traces_idscores(traces, metadata, idfunc=_get_id):
+def traces_idscores(traces, metadata, idfunc=_get_id, n_jobs=1):
     """Compute the amplitude anomaly score in [0, 1] from the given Traces and
     their identifiers. For details on the scores, see :func:`aa_scores`
 
@@ -77,6 +106,9 @@ def traces_idscores(traces, metadata, idfunc=_get_id):
     :param idfunc: the (optional) function `f(trace)` used to get the trace id.
         When None or missing, each trace id will be computed as the tuple
         `(trace_channel_seedID:str, trace_start:datetime, trace_end:datetime)`
+    :param n_jobs: the number of threads used to compute the features and
+        the scores (-1: as many as the CPUs). See
+        :func:`sdaas.core.psd.traces_psd` and :func:`aa_scores`
 
     :return: the tuple `(ids, scores)` where, called N the processed traces
         number, `ids` is a list N identifiers and scores is a numpy array of N
@@ -84,11 +116,11 @@ def traces_idscores(traces, metadata, idfunc=_get_id):
 
     .. seealso:: :func:`aa_scores`
     """
-    ids, feats = traces_idfeatures(traces, metadata, idfunc)
-    return ids, aa_scores(feats, check_nan=True)
+    ids, feats = traces_idfeatures(traces, metadata, idfunc, n_jobs)
+    return ids, aa_scores(feats, check_nan=True, n_jobs=n_jobs)
 
 
-def traces_scores(traces, metadata):
+def traces_scores(traces, metadata, n_jobs=1):
     """Compute the amplitude anomaly score in [0, 1] from the given Traces.
     For details, see :func:`aa_scores`
 
@@ -98,6 +130,9 @@ def traces_scores(traces, metadata):
         `Stream <https://docs.obspy.org/packages/autogen/obspy.core.stream.Stream.html>_`
     :param metadata: the Traces metadata as
         `Inventory <https://docs.obspy.org/packages/obspy.core.inventory.html>_`
+    :param n_jobs: the number of threads used to compute the features and
+        the scores (-1: as many as the CPUs). See
+        :func:`sdaas.core.psd.traces_psd` and :func:`aa_scores`
 
     :return: a numpy array of N floats in [0, 1], where N is the number of
         processed Traces.  NaN values might be present (meaning: could not
@@ -105,13 +140,15 @@ def traces_scores(traces, metadata):
 
     .. seealso:: :func:`aa_scores`
     """
-    feats = traces_features(traces, metadata)
-    return aa_scores(feats, check_nan=True)
+    feats = traces_features(traces, metadata, n_jobs)
+    return aa_scores(feats, check_nan=True, n_jobs=n_jobs)
 
 
 def trace_score(trace, metadata):
     """Compute the amplitude anomaly score in [0, 1] from the given Trace.
-    For details, see :func:`aa_scores`
+    For details, see :func:`aa_scores`. Note: to compute the scores of several
+    traces, use :func:`traces_scores` or :func:`streams_scores`, which are
+    much faster than calling this function in a loop
 
     :param trace: a
         `Trace <https://docs.obspy.org/packages/autogen/obspy.core.trace.Trace.html>_`
@@ -124,10 +161,11 @@ def trace_score(trace, metadata):
     .. seealso:: :func:`aa_scores`
     """
     feats = trace_features(trace, metadata)
-    return aa_scores(feats, check_nan=True)[0]
+    # pass a 1 x M matrix (a view) to skip the reshape of 1-D features:
+    return aa_scores(feats.reshape((1, -1)), check_nan=True, n_jobs=1)[0]
 
 
-def aa_scores(features, model=None, check_nan=True):
+def aa_scores(features, model=None, check_nan=True, n_jobs=-1):
     """Compute the amplitude anomaly scores from the given feature vectors,
     element wise. Returns a numpy array of anomaly scores in [0, 1], where
     the closer a scores is to 1, the more likely it represents an anomaly.
@@ -153,6 +191,10 @@ def aa_scores(features, model=None, check_nan=True):
         and skip their computation: NaNs (numpy.nan) will be returned for these
         elements. If this parameter is False, `features` must not contain
         NaNs, otherwise an Exception is raised
+    :param n_jobs: int (default -1: as many as the CPUs): the number of threads
+        used to compute the scores of big inputs (currently at least 2048
+        feature vectors). Ignored if scikit-learn is not installed (the
+        pre-trained model scores are simply interpolated, which is fast)
     :return: a numpy array of N scores in [0, 1] or NaNs (when the
         feature was NaN. Isolation Forest models do not handle NaNs in the
         feature space)
@@ -170,23 +212,33 @@ def aa_scores(features, model=None, check_nan=True):
     num_instances = features.shape[0]
 
     if check_nan:
-        finite = ~np.isnan(features).any(axis=1)
+        # A non-NaN sum (cheap scalar reduction) means no NaN in features (the
+        # common case): skip the mask of non-NaN rows below
+        with np.errstate(over='ignore', invalid='ignore'):
+            check_nan = np.isnan(features.sum())
+    if check_nan:
+        if features.shape[1] == 1:  # our case, avoid intermediate bool matrix
+            finite = ~np.isnan(features[:, 0])
+        else:
+            finite = ~np.isnan(features).any(axis=1)
         num_finite = finite.sum()
         if num_finite < num_instances:
             ret = np.full(num_instances, np.nan, dtype=float)
             if num_finite > 0:
                 if not model_fitted:
                     model.fit(features[finite])
-                ret[finite] = _aa_scores(features[finite], model)
+                ret[finite] = _aa_scores(features[finite], model, n_jobs)
             return ret
     if not model_fitted:
         model.fit(features)
-    return _aa_scores(features, model)
+    return _aa_scores(features, model, n_jobs)
 
 
 def _reshape_feature_space(features):
+    if isinstance(features, np.ndarray) and features.ndim == 2:
+        return features  # fast path (e.g., output of `traces_features`)
     features = np.asarray(features)
-    if len(features.shape) == 1 and len(FEATURES) == 1:
+    if features.ndim == 1 and len(FEATURES) == 1:
         features = features.reshape((len(features), 1))
     return features
 
@@ -211,17 +263,14 @@ FILE_NAME = ('clf=IsolationForest&'
              'n_estimators=50&'
              'random_state=11')
 
-try:
-    import sklearn
-    import joblib
-    sklearn_imported = True
-except ImportError:
-    sklearn_imported = False
+# Check if sklearn is installed without importing it (sklearn and joblib are
+# relatively slow to import, so import them lazily only when needed):
+sklearn_installed = find_spec('sklearn') is not None
 
 
-if not sklearn_imported:
+if not sklearn_installed:
 
-    def load_default_trained_model():
+    def _load_default_trained_model():
         x, y = [], []
         import csv
         model_file_path = join(ROOT_DIR, FILE_NAME) + ".scores.csv"
@@ -230,36 +279,233 @@ if not sklearn_imported:
             for row in reader:
                 x.append(float(row['psd@5sec']))
                 y.append(float(row['amplitude_anomaly_score']))
-        global DEFAULT_TRAINED_MODEL
-        DEFAULT_TRAINED_MODEL = {
+        return {
             'psd@5sec': np.asarray(x),
             'amplitude_anomaly_score': np.asarray(y)
         }
-        return DEFAULT_TRAINED_MODEL
 
-    def _aa_scores(features, model):
+    def _aa_scores(features, model, n_jobs=1):
         """Compute the anomaly scores by interpolating the values of a single feature
         Isolation Forest for the given `features` (a numpy matrix of Nx1 elements),
-        element wise. Features must NOT be NaN (this is not checked for)
+        element wise. Features must NOT be NaN (this is not checked for).
+        `n_jobs` is ignored
         """
-        return np.interp(features.flatten(), model['psd@5sec'],
+        return np.interp(features.ravel(), model['psd@5sec'],
                          model['amplitude_anomaly_score'])
 
 else:
 
-    # lazy load DEFAULT_TRAINED_MODEL
-    def load_default_trained_model():
-        global DEFAULT_TRAINED_MODEL
-        DEFAULT_TRAINED_MODEL = joblib.load(get_model_file_path() + '.sklmodel')
-        return DEFAULT_TRAINED_MODEL
+    def _load_default_trained_model():
+        import joblib
+        # mmap_mode='r': the model numpy arrays are memory mapped (read only),
+        # thus shared across processes loading the same model:
+        model = joblib.load(get_model_file_path() + '.sklmodel', mmap_mode='r')
+        _setup_fast_scoring(model)
+        return model
+
+
+    def _setup_fast_scoring(model):
+        """Pre-compute on the given (fitted) Isolation Forest all data which
+        does not depend on the input features, and which sklearn would
+        otherwise recompute at each `model.score_samples` call: the path length
+        of each tree node (node depth + average path length of the node samples)
+        and the scores normalization factor. The data is stored as model
+        attribute and used in :func:`_aa_scores`
+        """
+        model._sdaas_path_lengths = [
+            _node_depths(tree.tree_) +
+            _average_path_length(tree.tree_.n_node_samples)
+            for tree in model.estimators_
+        ]
+        model._sdaas_denominator = \
+            len(model.estimators_) * _average_path_length([model.max_samples_])[0]
+        # Trees fitted on all features in the same order (e.g., our default
+        # model with a single feature) do not need the features column
+        # selection (a copy) for each tree. Mark their features subset as None:
+        n_features = getattr(model, 'n_features_in_',
+                             getattr(model, 'n_features_', None))
+        model._sdaas_trees_features = [
+            None if n_features is not None and
+            np.array_equal(tree_features, np.arange(n_features))
+            else tree_features
+            for tree_features in model.estimators_features_
+        ]
+        # Single feature models (e.g., our default model) can be "compiled"
+        # into a lookup table of scores (see `_scores_lookup_table`):
+        if n_features == 1:
+            model._sdaas_thresholds, model._sdaas_scores = \
+                _scores_lookup_table(model)
+
+
+    def _scores_lookup_table(model):
+        """Return the tuple `(thresholds, scores)` of a fitted single-feature
+        Isolation Forest, where thresholds is the sorted array of the split
+        thresholds of all trees, and scores[i] the (constant) model score on
+        the i-th interval between thresholds (N thresholds => N+1 intervals).
+        Thus, the score of a feature x is `scores[searchsorted(thresholds, x)]`
+        (a binary search instead of traversing all trees). Requires the data
+        pre-computed in :func:`_setup_fast_scoring`
+        """
+        thresholds = np.unique(np.concatenate([
+            tree.tree_.threshold[tree.tree_.children_left >= 0]
+            for tree in model.estimators_
+        ]))
+        # `searchsorted(thresholds, x)` is the number of thresholds < x. As a
+        # sample x goes to the left child iff x <= the node threshold, the
+        # i-th interval goes left on a node iff i <= its threshold index:
+        intervals = np.arange(len(thresholds) + 1)
+        depths = np.zeros(len(intervals))
+        for tree, path_lengths in zip(model.estimators_,
+                                      model._sdaas_path_lengths):
+            tree = tree.tree_
+            children_left, children_right = tree.children_left, \
+                tree.children_right
+            threshold_index = np.searchsorted(thresholds, tree.threshold)
+            nodes = np.zeros(len(intervals), dtype=children_left.dtype)
+            while True:  # descend the tree with all intervals at once
+                split = children_left[nodes] >= 0
+                if not split.any():
+                    break
+                go_left = intervals <= threshold_index[nodes]
+                nodes = np.where(split, np.where(go_left, children_left[nodes],
+                                                 children_right[nodes]), nodes)
+            depths += path_lengths[nodes]
+        if model._sdaas_denominator == 0:
+            return thresholds, np.full(len(intervals), 0.5)  # 2 ** -1
+        # same operations as in `_fast_aa_scores` (same results):
+        depths /= -model._sdaas_denominator
+        return thresholds, np.power(2., depths, out=depths)
+
+
+    def _node_depths(tree):
+        """Return the depth of each node of the given tree (an instance of
+        `sklearn.tree._tree.Tree`) as numpy array, with the root having
+        depth 0
+        """
+        depths = np.zeros(tree.node_count)
+        children_left, children_right = tree.children_left, tree.children_right
+        nodes, depth = np.array([0]), 0
+        while len(nodes):  # visit the tree level by level
+            depth += 1
+            nodes = np.concatenate((children_left[nodes],
+                                    children_right[nodes]))
+            nodes = nodes[nodes >= 0]  # remove leaves "children" (-1)
+            depths[nodes] = depth
+        return depths
+
+
+    def _average_path_length(n_samples_leaf):
+        """Return the average path length in a n_samples iTree, i.e. the
+        average path length of an unsuccessful BST search, for each of the
+        given number of samples. Same as
+        `sklearn.ensemble._iforest._average_path_length` (re-implemented here as
+        sklearn private functions might be moved or renamed)
+        """
+        n_samples_leaf = np.asarray(n_samples_leaf, dtype=float)
+        avg_path_length = np.zeros(n_samples_leaf.shape)
+        avg_path_length[n_samples_leaf == 2] = 1.
+        mask = n_samples_leaf > 2
+        n = n_samples_leaf[mask]
+        avg_path_length[mask] = 2. * (np.log(n - 1.) + np.euler_gamma) - \
+            2. * (n - 1.) / n
+        return avg_path_length
 
 
-    def _aa_scores(features, model):
+    def _aa_scores(features, model, n_jobs=1):
         """Compute the anomaly scores of the Isolation Forest model for the given
-        `features` (a numpy matrix of Nx1 elements), element wise. Features must
-        NOT be NaN (this is not checked for)
+        `features` (a numpy matrix of Nx1 elements), element wise. Features
+        should not be NaN: if they are, they are scored as in
+        `model.score_samples` (which might raise). `n_jobs` is the number of
+        threads (-1: as many as the CPUs) used if features are big enough
         """
-        return -model.score_samples(features)
+        # sklearn trees work with float32 (the input is converted anyway, if
+        # needed). Convert here once, avoiding copies if already float32:
+        features = np.ascontiguousarray(features, dtype=np.float32)
+        if len(features) < _PARALLEL_MIN_SAMPLES:
+            n_jobs = 1  # the thread pool overhead is worth only for big inputs
+        elif n_jobs < 0:
+            n_jobs = os.cpu_count() or 1
+        if hasattr(model, '_sdaas_scores'):
+            return _score_nan_features(features, model, model._sdaas_scores[
+                np.searchsorted(model._sdaas_thresholds, features[:, 0])])
+        if hasattr(model, '_sdaas_trees_features'):
+            return _score_nan_features(features, model,
+                                       _fast_aa_scores(features, model, n_jobs))
+        if n_jobs == 1:
+            scores = model.score_samples(features)
+        else:
+            # Score chunks of features in parallel threads (sklearn trees
+            # traversal releases the GIL). Chunks are small enough to stay in
+            # the CPU cache while traversing all trees, and at least n_jobs:
+            num_chunks = max(n_jobs, -(-len(features) // _SCORES_CHUNK_SIZE))
+            chunks = np.array_split(features, num_chunks)  # (views, no copy)
+            with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+                scores = np.concatenate(list(executor.map(model.score_samples,
+                                                          chunks)))
+        return np.negative(scores, out=scores)  # in-place, no new array
+
+
+    def _score_nan_features(features, model, scores):
+        """Set in `scores` (the output of a fast scoring path, see
+        `_aa_scores`) the scores of the NaN rows of `features`, if any,
+        computed with `model.score_samples`, as the fast paths do not handle
+        NaNs as the model does. Return `scores` (modified in place)
+        """
+        # A non-NaN sum (cheap scalar reduction) means no NaN in features:
+        with np.errstate(over='ignore', invalid='ignore'):
+            if not np.isnan(features.sum()):
+                return scores
+        nan = np.isnan(features).any(axis=1)
+        if nan.any():
+            scores[nan] = -model.score_samples(features[nan])
+        return scores
+
+
+    # min. number of instances for which `_aa_scores` computes scores in parallel:
+    _PARALLEL_MIN_SAMPLES = 2048
+
+
+    def _fast_aa_scores(features, model, n_jobs=1):
+        """Same as `-model.score_samples(features)` but faster, using the data
+        pre-computed in :func:`_setup_fast_scoring`. `features` must be a
+        C-contiguous float32 array. `n_jobs` (positive int) is the number of
+        threads processing different chunks of `features` in parallel
+        """
+        denominator = model._sdaas_denominator
+        if denominator == 0:
+            return np.full(len(features), 0.5)  # 2 ** -1
+        depths = np.zeros(len(features))
+
+        def chunk_aa_depths(start):
+            chunk = features[start: start + _SCORES_CHUNK_SIZE]
+            chunk_depths = depths[start: start + _SCORES_CHUNK_SIZE]
+            for tree, tree_features, path_lengths in \
+                    zip(model.estimators_, model._sdaas_trees_features,
+                        model._sdaas_path_lengths):
+                x = chunk if tree_features is None else chunk[:, tree_features]
+                # sklearn computes the leaf depths with `tree.decision_path`
+                # (a sparse matrix, slow). Use the pre-computed depths instead:
+                chunk_depths += path_lengths[tree.apply(x, check_input=False)]
+
+        # Process features in chunks, so that the per-tree intermediate arrays
+        # fit in the CPU cache. Chunks write on different slices of `depths`,
+        # so they can be processed in parallel (`tree.apply` releases the GIL):
+        starts = range(0, len(features), _SCORES_CHUNK_SIZE)
+        if n_jobs == 1 or len(starts) < 2:
+            for start in starts:
+                chunk_aa_depths(start)
+        else:
+            with ThreadPoolExecutor(max_workers=min(n_jobs, len(starts))) as executor:
+                # (consume the results to raise exceptions, if any):
+                for _ in executor.map(chunk_aa_depths, starts):
+                    pass
+        # return 2 ** (-depths / denominator) without allocating new arrays:
+        depths /= -denominator
+        return np.power(2., depths, out=depths)
+
+
+    # max number of instances processed at once in `_fast_aa_scores`:
+    _SCORES_CHUNK_SIZE = 16384
 
 
     def get_model_file_path():
@@ -267,6 +513,7 @@ else:
         file_name = FILE_NAME
         # modify root_dir or file_name according to sklearn version:
         try:
+            import sklearn
             _sklearn_version_tuple = tuple(int(_) for _ in sklearn.__version__.split('.'))
         except (ImportError, ValueError, TypeError):
             _sklearn_version_tuple = None
@@ -286,3 +533,20 @@ else:
 
         return join(root_dir, file_name)
 
+
+def load_default_trained_model():
+    """Load and return the default trained model. The model is loaded only
+    once, subsequent calls return the same object (DEFAULT_TRAINED_MODEL).
+    The model is loaded lazily when first needed (see :func:`aa_scores`):
+    call this function at startup to preload it before time critical tasks.
+    Thread safe (the model is never loaded twice)
+    """
+    global DEFAULT_TRAINED_MODEL
+    if DEFAULT_TRAINED_MODEL is None:
+        with _LOAD_LOCK:
+            if DEFAULT_TRAINED_MODEL is None:  # not loaded while waiting
+                DEFAULT_TRAINED_MODEL = _load_default_trained_model()
+    return DEFAULT_TRAINED_MODEL
+
+
+_LOAD_LOCK = threading.Lock()
@@ -7,19 +7,34 @@ seismic waveform segments
 @author: Riccardo Z. <rizac@gfz-potsdam.de>
 """
 import math
+import os
+import threading
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 
 import numpy as np
 # from matplotlib import mlab
 # from obspy.signal.invsim import cosine_taper
 from obspy.core.inventory.inventory import Inventory
 
+try:  # scipy (installed with obspy) supports multi-threaded batched FFTs:
+    from scipy.fft import rfft as _rfft  # noqa
+
+    def _batch_rfft(x, n, axis=-1, workers=-1):
+        return _rfft(x, n=n, axis=axis, workers=workers)
+except ImportError:  # scipy < 1.4
+    def _batch_rfft(x, n, axis=-1, workers=-1):  # noqa (workers unused)
+        return np.fft.rfft(x, n=n, axis=axis)
+
 
 def trace_psd(tr, metadata,
               psd_periods=None,
               smooth_on_all_periods=False,
               period_smoothing_width_octaves=1.0,
               period_step_octaves=0.125,
-              special_handling=None):
+              special_handling=None,
+              dtype=float):
     """Calculate the power spectral density (PSD) of the given
     trace `tr`, and returns the values in dB at the given `psd_periods`.
 
@@ -60,6 +75,9 @@ def trace_psd(tr, metadata,
     :param special_handling: sensor details, for experienced users only. Can
         be `ringlaser', 'hydrophone' or any other value to specify neither of
         the two. Default: None
+    :param dtype: numpy float dtype (default: float, i.e. float64) of the
+        computation and of the returned values. `numpy.float32` is faster but
+        less precise (see :func:`traces_psd`)
     """
     # Convert to float, this is only necessary if in-place operations follow,
     # which was the case e.g. for the fft_taper function (see below)
@@ -69,6 +87,155 @@ def trace_psd(tr, metadata,
     # tr.data = tr.data.astype(np.float64)
 
     # if trace has a masked array we fill in zeros
+    _fill_masked(tr)
+
+    sampling_rate = tr.stats.sampling_rate
+    nfft, nlap = _get_nfft(tr)
+
+    # calculate the spectrum. Using matlab for this seems weird (as the PPSD
+    # has a strong focus on outputting plots, it makes sense, here not so much)
+    # but the function basically computes an fft and then its power spectrum.
+    # (also remember: matlab will be always available as ObsPy dependency)
+    # We call `_welch_psd`, i.e. `psd` specialized for our arguments
+    # (detrend=detrend_linear, window=fft_taper, sides='onesided',
+    # scale_by_freq=True), which also supports float32. Note: a 1-row view,
+    # so that the data is cast to float (if needed) with the detrend, only.
+    # Compute the FFT in this thread only (workers=1, see `traces_psd`):
+    spec, _freq = _welch_psd(tr.data[np.newaxis], nfft, sampling_rate, nlap,
+                             dtype, workers=1)
+    spec = spec[0]
+
+    # leave out first entry (offset)
+    spec = spec[1:]
+    freq = _freq[1:]
+
+    spec = _remove_response_db(spec, freq, tr, metadata, nfft,
+                               special_handling)
+    _psd_periods = 1.0 / freq[::-1]
+
+    if psd_periods is None:
+        return spec, _psd_periods
+
+    psd_periods = np.asarray(psd_periods)
+    val = _smooth_psd(spec, _psd_periods, psd_periods, smooth_on_all_periods,
+                      period_smoothing_width_octaves, period_step_octaves)
+    # (np.interp, used when smoothing on all periods, returns float64):
+    return val.astype(dtype, copy=False), psd_periods
+
+
+def traces_psd(traces, metadata, psd_periods,
+               smooth_on_all_periods=False,
+               period_smoothing_width_octaves=1.0,
+               period_step_octaves=0.125,
+               special_handling=None,
+               n_jobs=1,
+               dtype=float):
+    """Calculate the power spectral density (PSD) of all given traces, and
+    returns the values in dB at the given `psd_periods`, as N x M numpy array
+    (N = number of traces, M = number of periods). The output is the same as
+    `numpy.array([trace_psd(t, metadata, psd_periods, ...)[0] for t in traces])`
+    but faster, as traces with the same sampling rate and number of points are
+    stacked into a single matrix and processed at once (in batches of
+    limited size, see `_PSD_BATCH_SIZE`).
+
+    For details on the arguments, see :func:`trace_psd` (note that here
+    `psd_periods` can not be None)
+
+    :param traces: an iterable of ObsPy Traces (e.g. list, Stream)
+    :param n_jobs: int (default 1): the number of threads used to process
+        batches of traces in parallel (-1 means: as many as the CPUs). Most
+        of the computation is done in numpy, which releases the GIL, so
+        threads run in parallel. With a single batch, the threads are used
+        for its FFT only. In any case, no more than n_jobs threads are used
+    :param dtype: numpy float dtype (default: float, i.e. float64) of the
+        computation and of the returned matrix. `numpy.float32` halves the
+        memory moved and speeds up the FFTs, at the cost of precision (results
+        differ from the float64 ones roughly in the 6th significant digit)
+    """
+    traces = list(traces)
+    psd_periods = np.asarray(psd_periods)
+    ret = np.full((len(traces), len(psd_periods)), np.nan, dtype=dtype)
+
+    # group traces by (sampling_rate, npts). Note that nfft depends only on
+    # those two values:
+    groups = {}
+    for i, tr in enumerate(traces):
+        _fill_masked(tr)
+        stats = tr.stats  # (avoid repeated attribute lookups)
+        key = (stats.sampling_rate, stats.npts)
+        group = groups.get(key, None)
+        if group is None:
+            group = groups[key] = [_get_nfft(tr), []]
+        group[1].append(i)
+
+    # split groups into batches whose segments matrix (see `_welch_psd`)
+    # has at most `_PSD_BATCH_SIZE` elements:
+    batches = []
+    for (sampling_rate, npts), ((nfft, nlap), indices) in groups.items():
+        num_segments = (max(npts, nfft) - nlap) // (nfft - nlap)
+        size = max(1, _PSD_BATCH_SIZE // (num_segments * nfft))
+        for start in range(0, len(indices), size):
+            batches.append(((sampling_rate, npts),
+                            ((nfft, nlap), indices[start: start + size])))
+
+    # cache of the channel and evaluated responses, shared by all batches and
+    # discarded when this function returns:
+    responses_cache = {}
+
+    def batch_psd(key, value, workers=1):
+        (sampling_rate, npts), ((nfft, nlap), indices) = key, value
+        # stack the traces data into a pre-allocated float matrix (this
+        # also casts the data, if needed, without further copies):
+        data = np.empty((len(indices), npts), dtype=dtype)
+        for j, i in enumerate(indices):
+            data[j] = traces[i].data
+        specs, _freq = _welch_psd(data, nfft, sampling_rate, nlap,
+                                  workers=workers)
+        # leave out first entry (offset)
+        specs = specs[:, 1:]
+        freq = _freq[1:]
+        # working with the periods not frequencies later so reverse spectra
+        # (and freq, to compute omega only once for all spectra):
+        specs = specs[:, ::-1]
+        freq_r = freq[::-1]
+        for j, i in enumerate(indices):
+            specs[j] = _remove_response(specs[j], freq_r, traces[i], metadata,
+                                        nfft, special_handling,
+                                        responses_cache)
+        specs = _to_db(specs)
+        _psd_periods = 1.0 / freq[::-1]
+        ret[indices] = _smooth_psd(specs, _psd_periods, psd_periods,
+                                   smooth_on_all_periods,
+                                   period_smoothing_width_octaves,
+                                   period_step_octaves)
+
+    if n_jobs < 0:
+        n_jobs = os.cpu_count() or 1
+    if n_jobs == 1 or len(batches) < 2:
+        # (n_jobs threads for the FFTs only):
+        for key, value in batches:
+            batch_psd(key, value, workers=n_jobs)
+    else:
+        with ThreadPoolExecutor(max_workers=min(n_jobs, len(batches))) as executor:
+            # (consume the results to raise exceptions, if any). Run each FFT
+            # in the calling thread (workers=1) to not exceed n_jobs threads:
+            for _ in executor.map(lambda batch: batch_psd(*batch, workers=1),
+                                  batches):
+                pass
+
+    return ret
+
+
+# Max. number of elements of the segments matrix of a batch of traces processed
+# at once in `traces_psd`. Larger batches spend less time in Python calls, but
+# the batch arrays do not fit in the CPU cache anymore and all numpy
+# operations (detrend, FFT) get slower. The value below (512 KiB in float64)
+# is roughly the optimum measured on a 1 MiB L2 cache machine:
+_PSD_BATCH_SIZE = 2 ** 16
+
+
+def _fill_masked(tr):
+    """Fill with zeros the masked values of `tr.data`, if any (in place)"""
     try:
         tr.data[tr.data.mask] = 0.0
     # if it is no masked array, we get an AttributeError
@@ -76,9 +243,13 @@ def trace_psd(tr, metadata,
     except AttributeError:
         pass
 
+
+def _get_nfft(tr):
+    """Return the tuple (nfft, noverlap) used for computing the PSD of the
+    given trace"""
     # merging some PPSD.__init__ stuff here:
-    ppsd_length = tr.stats.endtime - tr.stats.starttime  # float, seconds
     stats = tr.stats
+    ppsd_length = stats.endtime - stats.starttime  # float, seconds
     sampling_rate = stats.sampling_rate
     # calculate derived attributes
     # nfft is determined mimicking the fft setup in McNamara&Buland
@@ -95,22 +266,28 @@ def trace_psd(tr, metadata,
     #  - use 75% overlap
     #    (we end up with a little more than 13 segments..)
     nlap = int(0.75 * nfft)
+    return nfft, nlap
 
-    # calculate the spectrum. Using matlab for this seems weird (as the PPSD
-    # has a strong focus on outputting plots, it makes sense, here not so much)
-    # but the function basically computes an fft and then its power spectrum.
-    # (also remember: matlab will be always available as ObsPy dependency)
-    spec, _freq = psd(tr.data, nfft, sampling_rate, detrend=detrend_linear,
-                      window=fft_taper, noverlap=nlap, sides='onesided',
-                      scale_by_freq=True)
-
-    # leave out first entry (offset)
-    spec = spec[1:]
-    freq = _freq[1:]
 
+def _remove_response_db(spec, freq, tr, metadata, nfft, special_handling=None):
+    """Remove the instrument response from the given spectrum `spec` (1-D
+    array, DC component excluded) and return it in dB, sorted by period (i.e.,
+    reversed)
+    """
     # working with the periods not frequencies later so reverse spectrum
-    spec = spec[::-1]
+    return _to_db(_remove_response(spec[::-1], freq[::-1], tr, metadata, nfft,
+                                   special_handling))
+
 
+def _remove_response(spec, freq, tr, metadata, nfft, special_handling=None,
+                     cache=None):
+    """Remove the instrument response from the given spectrum `spec` (1-D
+    array, DC component excluded) sorted by period, i.e. reversed, as
+    `freq`, the spectrum frequencies. `spec` might be modified in place
+
+    :param cache: dict or None. The responses cache (see
+        :func:`_get_response_from_inventory`)
+    """
     # Here we remove the response using the same conventions
     # since the power is squared we want to square the sensitivity
     # we can also convert to acceleration if we have non-rotational data
@@ -122,7 +299,7 @@ def trace_psd(tr, metadata,
     else:
         # determine instrument response from metadata
         try:
-            resp = _get_response(tr, metadata, nfft)
+            resp = _get_response(tr, metadata, nfft, cache)
         except Exception as e:
             msg = ("Error getting response from provided metadata:\n"
                    "%s: %s\n"
@@ -134,34 +311,42 @@ def trace_psd(tr, metadata,
 
         resp = resp[1:]
         resp = resp[::-1]
-        # Now get the amplitude response (squared)
-        respamp = np.absolute(resp * np.conjugate(resp))
-        # Make omega with the same conventions as spec
-        w = 2.0 * math.pi * freq
-        w = w[::-1]
-        # Here we do the response removal
+        # Now get the amplitude response (squared), i.e. |resp * conj(resp)|,
+        # without complex temporaries:
+        respamp = resp.real ** 2 + resp.imag ** 2
+        # Here we do the response removal (in place)
         # Do not differentiate when `special_handling="hydrophone"`
-        if special_handling == "hydrophone":
-            spec = spec / respamp
-        else:
-            spec = (w ** 2) * spec / respamp
+        if special_handling != "hydrophone":
+            # Make omega with the same conventions as spec
+            w = 2.0 * math.pi * freq
+            spec *= w ** 2
+        spec /= respamp
+    return spec
+
+
+def _to_db(spec):
+    """Convert the given spectrum (numpy array of any shape) in dB, in place"""
     # avoid calculating log of zero (define dtiny here. In obspy's PPSD it was
-    # imported from obspy.signal.spectral_estimation):
-    dtiny = np.finfo(0.0).tiny
-    spec[spec < dtiny] = dtiny
+    # imported from obspy.signal.spectral_estimation). Use the tiny value of
+    # spec dtype (float64 tiny is 0 in float32):
+    dtiny = np.finfo(spec.dtype).tiny
+    np.maximum(spec, dtiny, out=spec)  # (NaNs are preserved)
 
     # go to dB
-    spec = np.log10(spec)
+    spec = np.log10(spec, out=spec)
     spec *= 10
+    return spec
+
 
+def _smooth_psd(spec, _psd_periods, psd_periods, smooth_on_all_periods=False,
+                period_smoothing_width_octaves=1.0, period_step_octaves=0.125):
+    """Smooth the PSD values `spec` (in dB) defined at the given `_psd_periods`
+    and return the smoothed values at the given `psd_periods`. `spec` can
+    also be a 2-D array of N spectra (one per row): in this case, a N x M
+    matrix is returned (M = len(psd_periods))
+    """
     # setup variables for the final smoothed spectral values:
     smoothed_psd = []
-    _psd_periods = 1.0 / freq[::-1]
-
-    if psd_periods is None:
-        return spec, _psd_periods
-
-    psd_periods = np.asarray(psd_periods)
 
     if smooth_on_all_periods:
         # smooth the spectrum: for any period P in psd_periods[i] compute a
@@ -179,33 +364,45 @@ def trace_psd(tr, metadata,
                                             period_smoothing_width_octaves,
                                             period_step_octaves, period_limits):
             period_bin_left, period_bin_center, period_bin_right = periods_bins
-            _spec_slice = spec[(period_bin_left <= _psd_periods) &
-                               (_psd_periods <= period_bin_right)]
-            smoothed_psd.append(_spec_slice.mean())
+            _spec_slice = spec[..., _periods_slice(_psd_periods, period_bin_left,
+                                                   period_bin_right)]
+            smoothed_psd.append(_spec_slice.mean(axis=-1))
             period_bin_centers.append(period_bin_center)
         # interpolate. Use log10 as it was used for training (from tests,
         # linear interpolation does not change much anyway)
-        val = np.interp(
-            np.log10(psd_periods),
-            np.log10(period_bin_centers),
-            smoothed_psd
-        )
-        val[psd_periods < period_bin_centers[0]] = np.nan
-        val[psd_periods > period_bin_centers[-1]] = np.nan
+        smoothed_psd = np.stack(smoothed_psd, axis=-1)
+        xvals, xp = np.log10(psd_periods), np.log10(period_bin_centers)
+        if smoothed_psd.ndim == 1:
+            val = np.interp(xvals, xp, smoothed_psd)
+        else:
+            val = np.array([np.interp(xvals, xp, _) for _ in smoothed_psd])
+        val[..., psd_periods < period_bin_centers[0]] = np.nan
+        val[..., psd_periods > period_bin_centers[-1]] = np.nan
     else:
         # the width of frequencies we average over for every bin is controlled
         # by period_smoothing_width_octaves (default one full octave)
+        nan = np.full(spec.shape[:-1], np.nan)
         for period_bin_left, period_bin_right in \
                 _yield_period_binning(psd_periods,
                                       period_smoothing_width_octaves):
-            _spec_slice = spec[(period_bin_left <= _psd_periods) &
-                               (_psd_periods <= period_bin_right)]
-            smoothed_psd.append(_spec_slice.mean() if len(_spec_slice)
-                                else np.nan)
+            _spec_slice = spec[..., _periods_slice(_psd_periods, period_bin_left,
+                                                   period_bin_right)]
+            smoothed_psd.append(_spec_slice.mean(axis=-1)
+                                if _spec_slice.shape[-1] else nan)
 
-        val = np.array(smoothed_psd)
+        val = np.stack(smoothed_psd, axis=-1) if smoothed_psd else \
+            np.full(spec.shape[:-1] + (0,), np.nan)
 
-    return val, psd_periods
+    return val
+
+
+def _periods_slice(periods, period_min, period_max):
+    """Return the slice of the given sorted (ascending) periods within
+    `[period_min, period_max]`. Same as (but faster than) the boolean mask
+    `(period_min <= periods) & (periods <= period_max)`
+    """
+    return slice(np.searchsorted(periods, period_min, side='left'),
+                 np.searchsorted(periods, period_max, side='right'))
 
 
 ###################
@@ -285,24 +482,131 @@ def psd(x, nfft=None, fs=None, detrend=None, window=None,
                                   detrend_func=detrend, window=window,
                                   noverlap=noverlap, pad_to=pad_to,
                                   sides=sides, scale_by_freq=scale_by_freq,
-                                  mode='psd')
+                                  mode='psd', average=True)
+    return Pxx, freqs
+
+
+def _welch_psd(x, nfft, fs, noverlap, dtype=None, workers=-1):
+    """Compute the power spectral densities of all rows of the 2-D array `x`
+    with Welch's average periodogram method. This function is the batched
+    (2-D) counterpart of :func:`psd` with `detrend=detrend_linear`,
+    `window=fft_taper`, `sides='onesided'` and `scale_by_freq=True`, i.e. the
+    arguments used for computing our model features
+
+    :param x: 2-D numpy array of shape (K, N): K signals of N points each
+    :param nfft: int, the number of data points used in each block for the FFT
+    :param fs: float, the sampling frequency
+    :param noverlap: int, the number of points of overlap between segments
+    :param dtype: the float dtype of the computation. None (the default):
+        float32 if `x` is float32, otherwise float64 (double precision)
+    :param workers: the number of threads of the batched FFT (-1: as many as
+        the CPUs). Pass 1 when called from a pool of threads
+
+    :return: The tuple `Pxx, freqs` where Pxx is a numpy array of shape (K, F)
+        (one PSD per row of `x`) and freqs is the numpy array of the F
+        frequencies
+    """
+    x = np.asarray(x)
+    if dtype is None:
+        dtype = np.float32 if x.dtype == np.float32 else np.float64
+    dtype = np.dtype(dtype)
+    if x.shape[1] < nfft:  # zero pad x up to nfft
+        x = np.concatenate((x, np.zeros((x.shape[0], nfft - x.shape[1]),
+                                        dtype=dtype)), axis=1)
+
+    # segments matrix of shape (K, num_segments, nfft), without copying data:
+    step = nfft - noverlap
+    shape = (x.shape[0], (x.shape[1] - noverlap) // step, nfft)
+    strides = (x.strides[0], step * x.strides[1], x.strides[1])
+    result = np.lib.stride_tricks.as_strided(x, shape=shape, strides=strides)
+    # detrend, apply window and compute the (squared) amplitude spectrum:
+    window = _fft_taper_window(nfft).astype(dtype, copy=False)
+    result = _detrend_linear_and_window(result, window, dtype)
+    result = _batch_rfft(result, nfft, workers=workers)
+    # final psd is the mean of |result|^2 over all segments. Compute it in
+    # one reduction (no intermediate array of all |result|^2), and scale the
+    # averaged spectra only:
+    result = (np.einsum('ksf,ksf->kf', result.real, result.real) +
+              np.einsum('ksf,ksf->kf', result.imag, result.imag)) / \
+        result.shape[1]
+    freqs = np.fft.rfftfreq(nfft, 1 / fs)
+
+    # Scale everything, except the DC component and the NFFT/2 component (see
+    # `_spectral_helper` for details):
+    # (scale all in a single pass, then restore the two unscaled components):
+    result *= 2. / (fs * _fft_taper_window_sqsum(nfft))
+    result[..., 0] /= 2.
+    if not nfft % 2:
+        result[..., -1] /= 2.
+
+    return result, freqs
+
+
+def _detrend_linear_and_window(segments, window, dtype=None):
+    """Remove the linear trend from each segment and multiply it by `window`.
+    Vectorized version of `detrend_linear(segment) * window` for all segments
+    at once. See :func:`_detrend_linear_nd` for details
+
+    :param window: 1-D array, with length equal to the segments length
+    """
+    result = _detrend_linear_nd(segments, dtype)
+    result *= window
+    return result
+
+
+def _detrend_linear_nd(segments, dtype=None):
+    """Remove the linear trend from each segment. Vectorized version of
+    `detrend_linear(segment)` for all segments at once. Returns a new array,
+    `segments` (e.g. a strided view, see `stride_windows`) is not modified
+
+    :param segments: N-D array with the segments along the last axis
+    :param dtype: the dtype of the returned array. None (the default): at
+        least double precision, as in `detrend_linear`
+    """
+    if dtype is None:
+        dtype = np.result_type(segments.dtype, float)
+    result = segments.astype(dtype)  # new array: from here on, work in-place
+    t = np.arange(result.shape[-1], dtype=result.real.dtype)
+    t -= t.mean()
+    mean = result.mean(axis=-1, keepdims=True)
+    slope = (result @ t)[..., np.newaxis] / (t @ t)
+    result -= mean
+    result -= slope * t
+    return result
+
+
+def _window(segments, window, x):
+    """Multiply each column of `segments` (the detrended segments of the
+    array `x`) by `window`. The multiplication is in place if `segments` is
+    a new array (the detrend function made a copy), i.e. it does not share
+    memory with `x` and can hold the result without casting
+    """
+    window = window.reshape((-1, 1))
+    if np.may_share_memory(segments, x) or \
+            np.result_type(segments, window) != segments.dtype:
+        return segments * window
+    segments *= window
+    return segments
+
 
-    if Pxx.ndim == 2:  # result is a matrix, i.e.
-        # Pxx.shape[1] = num of windows (each windowed fft is on one column):
-        if Pxx.shape[1] > 1:  # many windows, final fft is the mean:
-            Pxx = Pxx.mean(axis=1)
-        else:  # only one window, take the (only) windowed fft:
-            Pxx = Pxx[:, 0]
-    return Pxx.real, freqs
+def _zero_pad(x, n):
+    """Return a copy of the 1-D array x zero padded up to length n"""
+    out = np.zeros(n, dtype=x.dtype)
+    out[:len(x)] = x
+    return out
 
 
 def _spectral_helper(x, y=None, NFFT=None, Fs=None, detrend_func=None,  # noqa
                      window=None, noverlap=None, pad_to=None,  # noqa
-                     sides=None, scale_by_freq=None, mode=None):
+                     sides=None, scale_by_freq=None, mode=None,
+                     average=False):
     """
     Private helper implementing the common parts between the psd, csd
     (cross spectral density), spectrogram and complex, magnitude, angle, and
     phase spectra.
+    If `average` is True and `mode` is 'psd' with y=None, the mean over all
+    segments (1-D array) is returned instead of the matrix of the spectra of
+    each segment (one per column)
     """
     if y is None:
         # if y is None use x for y
@@ -352,16 +656,13 @@ def _spectral_helper(x, y=None, NFFT=None, Fs=None, detrend_func=None,  # noqa
         if sides not in lst:
             raise ValueError('sides "%s" not in %s' % (str(sides), str(lst)))
 
-    # zero pad x and y up to NFFT if they are shorter than NFFT
+    # zero pad x and y up to NFFT if they are shorter than NFFT (copy into
+    # zeros: faster than np.resize, which repeats x and then resets the pad):
     if len(x) < NFFT:
-        n = len(x)
-        x = np.resize(x, NFFT)
-        x[n:] = 0
+        x = _zero_pad(x, NFFT)
 
     if not same_data and len(y) < NFFT:
-        n = len(y)
-        y = np.resize(y, NFFT)
-        y[n:] = 0
+        y = _zero_pad(y, NFFT)
 
     if pad_to is None:
         pad_to = NFFT
@@ -386,27 +687,57 @@ def _spectral_helper(x, y=None, NFFT=None, Fs=None, detrend_func=None,  # noqa
             numFreqs = pad_to//2 + 1
         scaling_factor = 2.
 
-    if not np.iterable(window):
+    window_sqsum = None  # sum of |window|^2 (computed later if None)
+    if window is fft_taper:  # our case (see `trace_psd`): use cached window
+        window = _fft_taper_window(NFFT)
+        window_sqsum = _fft_taper_window_sqsum(NFFT)
+    elif not np.iterable(window):
         window = window(np.ones(NFFT, x.dtype))
     if len(window) != NFFT:
         raise ValueError(
             "The window length must match the data's first dimension")
 
+    # For one-sided spectra of real data, compute only the non-negative
+    # frequencies with a real FFT (half the work of the full FFT):
+    if sides == 'onesided' and not np.iscomplexobj(x) and \
+            (same_data or not np.iscomplexobj(y)):
+        def fft(data):
+            return _batch_rfft(data, pad_to, axis=0)
+    else:
+        def fft(data):
+            return np.fft.fft(data, n=pad_to, axis=0)[:numFreqs, :]
+
+    # linear detrend (a Python loop over the segments, see `detrend`) and
+    # window can be computed at once on all segments with no extra copies:
+    fast_detrend = detrend_func is detrend_linear or detrend_func == 'linear'
+
     result = stride_windows(x, NFFT, noverlap, axis=0)
-    result = detrend(result, detrend_func, axis=0)
-    result = result * window.reshape((-1, 1))
-    result = np.fft.fft(result, n=pad_to, axis=0)[:numFreqs, :]
+    if fast_detrend:  # (work on segments as rows, hence the transpositions)
+        result = _detrend_linear_and_window(result.T, window).T
+    else:
+        result = _window(detrend(result, detrend_func, axis=0), window, x)
+    result = fft(result)
     freqs = np.fft.fftfreq(pad_to, 1/Fs)[:numFreqs]
 
     if not same_data:
         # if same_data is False, mode must be 'psd'
         resultY = stride_windows(y, NFFT, noverlap)
-        resultY = detrend(resultY, detrend_func, axis=0)
-        resultY = resultY * window.reshape((-1, 1))
-        resultY = np.fft.fft(resultY, n=pad_to, axis=0)[:numFreqs, :]
+        if fast_detrend:
+            resultY = _detrend_linear_and_window(resultY.T, window).T
+        else:
+            resultY = _window(detrend(resultY, detrend_func, axis=0), window,
+                              y)
+        resultY = fft(resultY)
         result = np.conj(result) * resultY
+    elif mode == 'psd' and average:
+        # mean of |result|^2 over the segments (columns) in one reduction,
+        # without the intermediate matrix of all |result|^2:
+        result = (np.einsum('ij,ij->i', result.real, result.real) +
+                  np.einsum('ij,ij->i', result.imag, result.imag)) / \
+            result.shape[1]
     elif mode == 'psd':
-        result = np.conj(result) * result
+        # |result|^2 (real), without the complex product conj(result) * result
+        result = result.real ** 2 + result.imag ** 2
     elif mode == 'magnitude':
         result = np.abs(result) / np.abs(window).sum()
     elif mode == 'angle' or mode == 'phase':
@@ -418,29 +749,30 @@ def _spectral_helper(x, y=None, NFFT=None, Fs=None, detrend_func=None,  # noqa
     if mode == 'psd':
 
         # Also include scaling factors for one-sided densities and dividing by
-        # the sampling frequency, if desired. Scale everything, except the DC
-        # component and the NFFT/2 component:
-
-        # if we have a even number of frequencies, don't scale NFFT/2
-        if not NFFT % 2:
-            slc = slice(1, -1, None)
-        # if we have an odd number, just don't scale DC
-        else:
-            slc = slice(1, None, None)
-
-        result[slc] *= scaling_factor
+        # the sampling frequency, if desired.
 
         # MATLAB divides by the sampling frequency so that density function
         # has units of dB/Hz and can be integrated by the plotted frequency
         # values. Perform the same scaling here.
         if scale_by_freq:
-            result /= Fs
             # Scale the spectrum by the norm of the window to compensate for
             # windowing loss; see Bendat & Piersol Sec 11.5.2.
-            result /= (np.abs(window)**2).sum()
+            if window_sqsum is None:
+                window_sqsum = (np.abs(window)**2).sum()
+            norm = Fs * window_sqsum
         else:
             # In this case, preserve power in the segment, not amplitude
-            result /= np.abs(window).sum()**2
+            norm = np.abs(window).sum()**2
+
+        # Scale everything (in a single pass), then restore the DC component
+        # and the NFFT/2 component, which must not be scaled by
+        # `scaling_factor`:
+        result *= scaling_factor / norm
+        if scaling_factor != 1:
+            result[0] /= scaling_factor
+            # if we have a even number of frequencies, restore NFFT/2
+            if not NFFT % 2:
+                result[-1] /= scaling_factor
 
     if sides == 'twosided':
         # center the frequency range at zero
@@ -563,6 +895,10 @@ def detrend(x, key=None, axis=None):
             raise ValueError(f'axis(={axis}) out of bounds')
         if (axis is None and x.ndim == 0) or (not axis and x.ndim == 1):
             return key(x)
+        if key is detrend_linear and axis is not None:
+            # vectorized version (no Python loop, see below):
+            return np.moveaxis(_detrend_linear_nd(np.moveaxis(x, axis, -1)),
+                               -1, axis)
         # try to use the 'axis' argument if the function supports it,
         # otherwise use apply_along_axis to do it
         try:
@@ -654,12 +990,16 @@ def detrend_linear(y):
     if not y.ndim:
         return np.array(0., dtype=y.dtype)
 
-    x = np.arange(y.size, dtype=float)
-
-    C = np.cov(x, y, bias=1)
-    b = C[0, 1]/C[0, 0]
+    # Least squares line, with x = [0, ..., n-1] (closed form sums, faster
+    # than np.cov which copies and stacks x and y): b = cov(x, y) / var(x),
+    # computed with the centered x (t):
+    n = y.size
+    x = np.arange(n, dtype=float)
+    x_mean = (n - 1) / 2.
+    t = x - x_mean
+    b = (t @ y) / (n * (n * n - 1) / 12.)  # (denominator: t @ t)
 
-    a = y.mean() - b*x.mean()
+    a = y.mean() - b*x_mean
     return y - (b*x + a)
 
 
@@ -673,7 +1013,26 @@ def fft_taper(data):
     Re-implements obspy.signal.spectral_estimation.fft_taper to avoid inplace
     operations (not necessary here)
     """
-    return data * cosine_taper(len(data), 0.2)
+    return data * _fft_taper_window(len(data))
+
+
+@lru_cache(maxsize=16)
+def _fft_taper_window(npts):
+    """Return the window used in :func:`fft_taper` for data of length `npts`.
+    The window is cached (npts depends only on the traces sampling rate, see
+    `_get_nfft`) and thus read-only
+    """
+    window = cosine_taper(npts, 0.2)
+    window.setflags(write=False)
+    return window
+
+
+@lru_cache(maxsize=16)
+def _fft_taper_window_sqsum(npts):
+    """Return the sum of the squares of :func:`_fft_taper_window` (`npts`),
+    i.e. the window norm used in the PSD scaling (cached)
+    """
+    return float((_fft_taper_window(npts) ** 2).sum())
 
 
 def cosine_taper(npts, p=0.1, freqs=None, flimit=None, halfcosine=True,
@@ -788,7 +1147,7 @@ def window_hanning(x):
 ##########################
 
 
-def _get_response(tr, metadata, nfft):
+def _get_response(tr, metadata, nfft, cache=None):
     """Return the response from the given trace and the given metadata
     Simplified version of:
     :meth:`~obspy.signal.spectral_estimation.PPSD._get_response`
@@ -800,7 +1159,7 @@ def _get_response(tr, metadata, nfft):
     # might be integrated with new metadata object. For the
     # moment `metadata` must be an Inventory object
     if isinstance(metadata, Inventory):
-        return _get_response_from_inventory(tr, metadata, nfft)
+        return _get_response_from_inventory(tr, metadata, nfft, cache)
 #         elif isinstance(self.metadata, Parser):
 #             return self._get_response_from_parser(tr)
 #         elif isinstance(self.metadata, dict):
@@ -814,16 +1173,44 @@ def _get_response(tr, metadata, nfft):
     raise TypeError(msg)
 
 
-def _get_response_from_inventory(tr, metadata, nfft):
+def _get_response_from_inventory(tr, metadata, nfft, cache=None):
     """Alias of
     :meth:`~obspy.signal.spectral_estimation.PPSD._get_response_from_inventory`
     (rationale: to optimize the PSD computation, we need to re-implement
     some methods of :class:`~obspy.signal.spectral_estimation.PPSD`)
+
+    :param cache: dict or None. If a dict, it is used to cache (and
+        retrieve) the channel responses and the evaluated responses. It is
+        up to the caller to create and discard it (see :func:`traces_psd`):
+        the inventory must not be modified while the cache is in use
     """
+    if cache is None:
+        cache = {}
     inventory = metadata
     delta = 1.0 / tr.stats.sampling_rate
     id_ = "%(network)s.%(station)s.%(location)s.%(channel)s" % tr.stats
-    response = inventory.get_response(id_, tr.stats.starttime)
+    response = _get_inventory_response(inventory, id_, tr.stats.starttime,
+                                       cache)
+    # evaluating the response is by far the most time consuming part of the
+    # PSD computation, and it is usually the same for many traces (e.g.,
+    # several time windows of the same channel). So cache it. Note that the
+    # cache key includes the id of the Response object, which is unique as
+    # long as the inventory (holding a reference to it) is not modified:
+    key = ('evalresp', id(response), delta, nfft)
+    resp = cache.get(key, None)
+    if resp is None:
+        # evalresp is not thread safe (see `traces_psd`). Serialize it:
+        with _EVALRESP_LOCK:
+            resp = cache.get(key, None)  # (set by another thread?)
+            if resp is None:
+                resp = cache[key] = _evalresp(response, delta, nfft)
+    return resp
+
+
+def _evalresp(response, delta, nfft):
+    """Evaluate the given response and return it as read-only array. Called
+    by :func:`_get_response_from_inventory` with `_EVALRESP_LOCK` acquired
+    """
     # In new ObsPy versions you can uncomment this line:
     # resp, _ = response.get_evalresp_response(t_samp=delta, nfft=nfft,
     #             output="VEL", hide_sensitivity_mismatch_warning=True)
@@ -833,9 +1220,48 @@ def _get_response_from_inventory(tr, metadata, nfft):
     # wrapping functions in this module:
     resp, _ = get_evalresp_response(response, t_samp=delta, nfft=nfft,
                                     output="VEL")
+    resp.flags.writeable = False  # cached and shared, prevent modifications
     return resp
 
 
+def _get_inventory_response(inventory, seed_id, datetime, cache=None):
+    """Same as `inventory.get_response(seed_id, datetime)`, but faster when
+    called several times with the same inventory, channel and `cache` dict
+    (e.g., several time windows of the same channel), as the channel
+    responses are cached. See :func:`_get_response_from_inventory`
+    """
+    key = ('channels', seed_id)
+    channels = None if cache is None else cache.get(key, None)
+    if channels is None:
+        # search the inventory only once per channel, and store all epochs:
+        network, station, location, channel = seed_id.split(".")
+        channels = [
+            (cha.start_date, cha.end_date, cha.response)
+            for net in inventory.networks if net.code == network
+            for sta in net.stations if sta.code == station
+            for cha in sta.channels
+            if cha.code == channel and cha.location_code == location and
+            cha.response is not None
+        ]
+        if cache is not None:
+            cache[key] = channels
+
+    responses = [response for start, end, response in channels
+                 if (start is None or start <= datetime) and
+                 (end is None or end >= datetime)]
+    if len(responses) > 1:
+        msg = "Found more than one matching response. Returning first."
+        warnings.warn(msg)
+    elif len(responses) < 1:
+        msg = "No matching response information found."
+        raise Exception(msg)
+    return responses[0]
+
+
+# evalresp is not thread safe (see `_get_response_from_inventory`):
+_EVALRESP_LOCK = threading.Lock()
+
+
 def get_evalresp_response(response, t_samp, nfft, output="VEL",
                           start_stage=None, end_stage=None):
     """Alias of
@@ -6,6 +6,7 @@
 import argparse
 from argparse import RawTextHelpFormatter
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 import sys
 import re
 import inspect
@@ -15,22 +16,22 @@ import warnings
 from datetime import timedelta, datetime
 from os.path import isdir, splitext, isfile, join, abspath, basename
 from os import listdir
-from urllib import request
 
 import numpy as np
 from obspy.core.stream import read
 from obspy.core.inventory.inventory import read_inventory
 
-from sdaas.core import traces_scores
+from sdaas.core import traces_scores, aa_scores
 from sdaas.core.model import load_default_trained_model
 from sdaas.cli.utils import ansi_colors_escape_codes, ProgressBar
+from sdaas.cli.cache import FeaturesCache
 from sdaas.cli import fdsn
 
 
 def process(data, metadata='', threshold=-1.0, aggregate='',
             waveform_length=120,  # in sec
             download_count=5, download_timeout=30,  # in sec
-            sep='', verbose=False):
+            sep='', verbose=False, cache=''):
     """Compute and print the amplitude anomaly scores of each waveform segment
     in 'data'. Anomalies are typically due to broken sensor, artifacts in the data
     (e.g. spikes, zero-amplitude signals, unusual noise) or in the metadata (e.g.,
@@ -119,6 +120,13 @@ def process(data, metadata='', threshold=-1.0, aggregate='',
         info and errors will be printed to stderr. Also in this case, the
         tabular output header will be printed to stdout instead of stderr,
         which is useful to create CSV files with headers
+
+    :param cache: path to a file where to cache the waveforms features (the
+        extension ".npz" will be appended, if missing). Useful when the same
+        waveforms are processed several times (e.g., running this program
+        with the same url): the features of the waveforms already processed
+        will be loaded from the cache instead of being computed. Default: ""
+        (no cache)
     """
     separator = sep
     sort_by_time = True
@@ -146,11 +154,15 @@ def process(data, metadata='', threshold=-1.0, aggregate='',
     else:
         raise ValueError(f'Invalid file/directory/FDSN url: {data}')
 
+    features_cache = FeaturesCache(cache) if cache else None
     rows = streamiterator.process(sort_by_time=sort_by_time and not aggregate,
                                   aggregate=aggregate,
                                   progressbar_output=sys.stderr,
                                   info_output=None if not verbose else sys.stderr,
-                                  download_timeout=download_timeout)
+                                  download_timeout=download_timeout,
+                                  features_cache=features_cache)
+    if features_cache is not None:
+        features_cache.save()
     if rows:
         sep = separator or ' '
         score_caption = 'anomaly_score'
@@ -166,7 +178,8 @@ def process(data, metadata='', threshold=-1.0, aggregate='',
 
 
 def is_remote_url(path_or_url):
-    return "://" in path_or_url  # copied from obspy.core.util.base._generic_reader
+    # copied from obspy.core.util.base._generic_reader:
+    return isinstance(path_or_url, str) and "://" in path_or_url
 
 
 def print_result(trace_id: str, trace_start: datetime,
@@ -207,15 +220,33 @@ def download(url, timeout=None):
     """obspy creates Temporary files when supplying URLs for miniSEED
     (same for inventories?). So let's handle this here
     """
-    with request.urlopen(request.Request(url), timeout=timeout or 30) as resp:
-        bio = BytesIO()
-        while True:
-            chunk = resp.read(1024)
-            if not chunk:
-                break
-            bio.write(chunk)
-        bio.seek(0)
-        return bio
+    response = fdsn.get_session().get(url, timeout=timeout or 30)
+    response.raise_for_status()
+    return BytesIO(response.content)
+
+
+def download_all(paths_or_urls, timeout=None, max_workers=16):
+    """Download all remote urls in parallel threads (downloads are I/O bound).
+    Yield the tuple (path_or_url, data) for each element of the input, in the
+    same order, where data is the downloaded BytesIO, the exception raised
+    while downloading or - if not remote url - the input path
+    """
+    def _download(path_or_url):
+        if not is_remote_url(path_or_url):
+            return path_or_url
+        try:
+            return download(path_or_url, timeout)
+        except Exception as exc:
+            return exc
+
+    num_urls = sum(is_remote_url(_) for _ in paths_or_urls)
+    if num_urls < 4:  # not worth a thread pool
+        for path_or_url in paths_or_urls:
+            yield path_or_url, _download(path_or_url)
+        return
+
+    with ThreadPoolExecutor(max_workers=min(num_urls, max_workers)) as executor:
+        yield from zip(paths_or_urls, executor.map(_download, paths_or_urls))
 
 
 def read_metadata(path_or_url, download_timeout=None):
@@ -272,23 +303,25 @@ class StreamIterator:
         params.pop('format', None)
         metadata_path = fdsn.build_url(station_url, **params)
 
+        wlen = timedelta(seconds=float(waveform_length))
+        wlen_seconds = wlen.total_seconds()
         for dataselect_url in fdsn.get_dataselect_urls(url):
             params = fdsn.querydict(dataselect_url)
-            start = datetime.fromisoformat(params['start'])
-            end = datetime.fromisoformat(params['end'])
+            start = fdsn.parse_datetime(params['start'])
+            end = fdsn.parse_datetime(params['end'])
             total_seconds = (end - start).total_seconds()
-            wlen = timedelta(seconds=float(waveform_length))
-            max_download_count = int(total_seconds / wlen.total_seconds())
+            max_download_count = int(total_seconds / wlen_seconds)
             if max_download_count < 1:
                 raise ValueError(f'Total download period (~={int(total_seconds)}s) < '
-                                 f'download window ({wlen.total_seconds()}s)')
+                                 f'download window ({wlen_seconds}s)')
             max_download_count = min(max_download_count, download_count)
+            step = timedelta(seconds=total_seconds/max_download_count)
             for _ in range(max_download_count):
                 params['start'] = start.replace(microsecond=0).isoformat()
                 params['end'] = (start+wlen).replace(microsecond=0).isoformat()
                 url = fdsn.build_url(dataselect_url,  **params)
                 self._data[metadata_path].append(url)
-                start += timedelta(seconds=total_seconds/max_download_count)
+                start += step
 
     def add_dir(self, path, metadata_path=None):
         """Add a new directory, populated with miniSEED (*.mseed) files
@@ -326,7 +359,8 @@ class StreamIterator:
                 aggregate: str or None = None,
                 progressbar_output: TextIO or None = sys.stderr,
                 info_output: TextIO or None = None,
-                download_timeout: int or None = None):
+                download_timeout: int or None = None,
+                features_cache: FeaturesCache or None = None):
         """Processes all added files/URLs and return the results"""
         if aggregate:
             aggregates = ('min', 'max', 'median', 'mean')
@@ -362,11 +396,13 @@ class StreamIterator:
                         continue
 
                 traces = []
-                for path in waveform_paths:
+                for path, data in download_all(waveform_paths, download_timeout):
                     pbar_val += pbar_step
                     pbar.set_progress(pbar_val)
                     try:
-                        for t in read_data(path, download_timeout=download_timeout):
+                        if isinstance(data, Exception):
+                            raise data
+                        for t in read_data(data):
                             traces.append(t)
                     except Exception as exc:
                         if info_output:
@@ -375,7 +411,12 @@ class StreamIterator:
                 if not traces:
                     continue
 
-                scores = traces_scores(traces, self._metadata_cache[metadata_path])
+                metadata = self._metadata_cache[metadata_path]
+                if features_cache is not None:
+                    scores = aa_scores(features_cache.traces_features(
+                        traces, metadata, metadata_path))
+                else:
+                    scores = traces_scores(traces, metadata)
                 for trace, score in zip(traces, scores):
                     streams[trace.get_id()].append({
                         'id': trace.get_id(),
@@ -468,7 +509,8 @@ def cli_entry_point():
         ('-wl', 'waveform_length'),
         ('-dc', 'download_count'),
         ('-dt', 'download_timeout'),
-        ('-v', 'verbose')
+        ('-v', 'verbose'),
+        ('-c', 'cache')
     ]:
         param_default, param_doc = getdef(name), getdoc(name)
         kwargs = {
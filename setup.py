@@ -11,7 +11,7 @@ setup(
     description=_README,
     url='https://github.com/rizac/sdaas',
     packages=find_packages(exclude=['tests', 'tests.*']),
-    python_requires='>=3.6.9',
+    python_requires='>=3.7',
     # Minimal requirements, for a complete list see requirements-*.txt
     install_requires=[
         'numpy>=1.15.4',
@@ -0,0 +1,116 @@
+"""
+Tests the fdsn module (FDSN URLs parsing and building)
+
+Created on 16 Oct 2026
+
+@author: Riccardo Z. <rizac@gfz-potsdam.de>
+"""
+import unittest
+from datetime import datetime
+
+from sdaas.cli.fdsn import get_station_and_dataselect_urls, querydict, \
+    build_url, _get_dataselect_urls, is_fdsn_url, parse_datetime
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        pass
+
+    def tearDown(self):
+        pass
+
+    def test_get_station_and_dataselect_urls(self):
+        station_url = ('http://geofon.gfz-potsdam.de/fdsnws/station/1/'
+                       'query?net=GE&sta=EIL&cha=BH?&start=2019-06-01')
+        dataselect_url = station_url.replace('/station/', '/dataselect/')
+        for url in [station_url, dataselect_url]:
+            assert is_fdsn_url(url)
+            urls = get_station_and_dataselect_urls(url)
+            assert urls == (station_url, dataselect_url)
+
+        for url in ['http://geofon.gfz-potsdam.de/fdsnws/event/1/query',
+                    'geofon.gfz-potsdam.de/fdsnws/station/1/query',
+                    '/fdsnws/station/1/query']:
+            assert not is_fdsn_url(url)
+            with self.assertRaises(ValueError):
+                get_station_and_dataselect_urls(url)
+
+    def test_querydict(self):
+        url = ('http://geofon.gfz-potsdam.de/fdsnws/station/1/'
+               'query?network=GE&sta=EIL&channel=BH?&starttime=2019-06-01'
+               '&end=2019-06-02T01:02:03')
+        assert querydict(url) == {
+            'net': 'GE',
+            'sta': 'EIL',
+            'cha': 'BH?',
+            'start': '2019-06-01',
+            'end': '2019-06-02T01:02:03'
+        }
+        for invalid_query in [
+            'net=GE&network=GE',  # multiple values
+            'net=GE&net=GE',  # multiple values
+            'start=2019-06-01T00:00:00&end=2019-06-01',  # invalid range
+            'start=2019-06-01&end=2019-06-01',  # invalid range
+            'start=2019-06-01&end=x',  # invalid date-time
+            'start=3000-01-01',  # invalid range (start in the future)
+        ]:
+            with self.assertRaises(ValueError):
+                querydict(url[:url.index('?') + 1] + invalid_query)
+        # trailing "Z" (UTC) is accepted:
+        assert querydict(url[:url.index('?') + 1] +
+                         'start=2019-06-01T00:00:00Z&end=2019-06-02Z') == {
+            'start': '2019-06-01T00:00:00Z', 'end': '2019-06-02Z'
+        }
+        # invalid dates are not checked when check_dates=False:
+        assert querydict(url[:url.index('?') + 1] + 'start=x',
+                         check_dates=False) == {'start': 'x'}
+
+    def test_parse_datetime(self):
+        for value in ['2019-06-01T01:02:03.5', '2019-06-01T01:02:03.500000Z',
+                      '2019-06-01T01:02:03.5z']:
+            assert parse_datetime(value) == datetime(2019, 6, 1, 1, 2, 3, 500000)
+        assert parse_datetime('2019-06-01') == datetime(2019, 6, 1)
+        for value in ['', 'Z', 'x', '2019-13-01']:
+            with self.assertRaises(ValueError):
+                parse_datetime(value)
+
+    def test_get_dataselect_urls(self):
+        station_text = """#Network | Station | Latitude | Longitude | Elevation | SiteName | StartTime | EndTime
+GE|EIL|29.6699|34.9512|210.0|GEOFON/MedNet Station #1, "Eilat"|1999-01-01T00:00:00|
+GE|APE|37.0689|25.5306|620.0|GEOFON Station Apirathos, Naxos|2005-05-17T00:00:00|2020-01-01T00:00:00
+"""
+        dataselect_url = 'http://geofon.gfz-potsdam.de/fdsnws/dataselect/1/query'
+        urls = _get_dataselect_urls(dataselect_url,
+                                    {'net': 'GE', 'cha': 'BH?', 'level': 'station'},
+                                    station_text)
+        assert len(urls) == 2
+        assert urls[1] == (dataselect_url + '?net=GE&cha=BH?&sta=APE'
+                           '&start=2005-05-17T00:00:00&end=2020-01-01T00:00:00')
+        params = querydict(urls[0])
+        assert params.pop('end')  # current time (end time missing)
+        assert params == {'net': 'GE', 'sta': 'EIL', 'cha': 'BH?',
+                          'start': '1999-01-01T00:00:00'}
+        assert _get_dataselect_urls(dataselect_url, {}, '') == []
+
+    def test_build_url(self):
+        url = 'http://geofon.gfz-potsdam.de/fdsnws/station/1/query?net=GE'
+        new_url = build_url(url, sta='EIL', level='response')
+        assert new_url == ('http://geofon.gfz-potsdam.de/fdsnws/station/1/'
+                           'query?sta=EIL&level=response')
+        assert querydict(new_url) == {'sta': 'EIL', 'level': 'response'}
+        # test values are converted to str and quoted, if needed:
+        new_url = build_url(url, net='G E', sta='A&B+', cha='BH?,HH*',
+                            start=datetime(2019, 6, 1, 1, 2, 3), level=1)
+        assert new_url == ('http://geofon.gfz-potsdam.de/fdsnws/station/1/'
+                           'query?net=G+E&sta=A%26B%2B&cha=BH?,HH*'
+                           '&start=2019-06-01T01:02:03&level=1')
+        assert querydict(new_url) == {'net': 'G E', 'sta': 'A&B+',
+                                      'cha': 'BH?,HH*',
+                                      'start': '2019-06-01T01:02:03',
+                                      'level': '1'}
+
+
+if __name__ == "__main__":
+    #  import sys;sys.argv = ['', 'Test.testName']
+    unittest.main()
@@ -7,7 +7,12 @@ Created on 22 Jun 2020
 
 @author: Riccardo Z. <rizac@gfz-potsdam.de>
 """
+import sys
+import subprocess
+from importlib import import_module
+from importlib.util import find_spec
 import unittest
+from unittest.mock import patch
 from os.path import join, dirname
 
 import numpy as np
@@ -15,9 +20,12 @@ from obspy.core.stream import read, Stream
 from obspy.core.inventory.inventory import read_inventory
 from obspy.signal.spectral_estimation import PPSD
 
-from sdaas.core import trace_psd
-from sdaas.core.model import aa_scores
-from sdaas.core.features import traces_features
+from sdaas.core import trace_psd, traces_psd
+from sdaas.core.model import aa_scores, streams_idscores, \
+    iter_streams_idscores, streams_scores, traces_idscores, traces_scores
+from sdaas.core.features import traces_features, streams_idfeatures, \
+    iter_streams_idfeatures, traces_ids, trace_features, featappend, \
+    featappend_many
 
 
 class Test(unittest.TestCase):
@@ -91,6 +99,269 @@ class Test(unittest.TestCase):
                     _psds_new = trace_psd(_, metadata, psd_periods_to_test)[0]
                     assert np.allclose(_psds_old, _psds_new, equal_nan=True)
 
+    def test_traces_psd(self):
+        """tests that the PSDs computed in batch (traces with the same
+        sampling rate and number of points processed together) are the same
+        as those computed trace by trace
+        """
+        psd_periods_to_test = [0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10,
+                               15, 20]
+        dataroot = join(dirname(__file__), 'data')
+        for file, inv in (
+            [
+                join(dataroot, 'trace_GE.APE.mseed'),
+                join(dataroot, 'inventory_GE.APE.xml')
+            ],
+            [
+                join(dataroot, 'GE.FLT1..HH?.mseed'),
+                join(dataroot, 'GE.FLT1.xml')
+            ],
+        ):
+            stream = read(file)
+            # add also traces with the same length (processed in batch)
+            # and shorter traces (processed in a separate batch):
+            stream += stream.copy()
+            for t in stream.copy():
+                stream.append(t.slice(t.stats.starttime,
+                                      t.stats.starttime + 50))
+            metadata = read_inventory(inv)
+            for smooth_on_all_periods in [False, True]:
+                psds = traces_psd(stream, metadata, psd_periods_to_test,
+                                  smooth_on_all_periods=smooth_on_all_periods)
+                assert psds.shape == (len(stream), len(psd_periods_to_test))
+                for _psds_new, trace in zip(psds, stream):
+                    _psds = trace_psd(trace, metadata, psd_periods_to_test,
+                                      smooth_on_all_periods=smooth_on_all_periods)[0]
+                    assert np.allclose(_psds, _psds_new, rtol=1.e-8,
+                                       equal_nan=True)
+                # test multi-threading gives the same results:
+                psds_mt = traces_psd(stream, metadata, psd_periods_to_test,
+                                     smooth_on_all_periods=smooth_on_all_periods,
+                                     n_jobs=4)
+                assert np.array_equal(psds, psds_mt, equal_nan=True)
+                # test single precision gives (almost) the same results:
+                psds_32 = traces_psd(stream, metadata, psd_periods_to_test,
+                                     smooth_on_all_periods=smooth_on_all_periods,
+                                     dtype=np.float32)
+                assert psds_32.dtype == np.float32
+                assert np.allclose(psds, psds_32, rtol=1.e-5, equal_nan=True)
+                for _psds_32, trace in zip(psds_32, stream):
+                    _psds = trace_psd(trace, metadata, psd_periods_to_test,
+                                      smooth_on_all_periods=smooth_on_all_periods,
+                                      dtype=np.float32)[0]
+                    assert np.array_equal(_psds, _psds_32, equal_nan=True)
+
+    def test_psd_fft_workers(self):
+        """tests that the FFTs do not use more threads than n_jobs"""
+        dataroot = join(dirname(__file__), 'data')
+        stream = read(join(dataroot, 'GE.FLT1..HH?.mseed'))
+        metadata = read_inventory(join(dataroot, 'GE.FLT1.xml'))
+        # (sdaas.core.psd is the psd function, not the module. Use importlib):
+        psd_module = import_module('sdaas.core.psd')
+        with patch.object(psd_module, '_batch_rfft',
+                          side_effect=psd_module._batch_rfft) as mock_rfft:
+            trace_psd(stream[0], metadata, [5])
+            traces_psd(stream, metadata, [5])  # n_jobs=1
+            traces_psd(stream, metadata, [5], n_jobs=2)  # 3 batches, 2 threads
+            assert mock_rfft.call_count == 7
+            for call in mock_rfft.call_args_list:
+                assert call[1]['workers'] == 1
+            # single batch: the FFT uses n_jobs threads:
+            traces_psd(stream[:1], metadata, [5], n_jobs=3)
+            assert mock_rfft.call_args[1]['workers'] == 3
+
+    def test_trace_psd_float32_data(self):
+        """tests that the psd of float32 data is computed in double precision
+        """
+        dataroot = join(dirname(__file__), 'data')
+        stream = read(join(dataroot, 'GE.FLT1..HH?.mseed'))
+        metadata = read_inventory(join(dataroot, 'GE.FLT1.xml'))
+        for trace in stream:
+            trace.data = trace.data.astype(np.float32)
+            expected = trace.copy()
+            expected.data = expected.data.astype(float)
+            assert np.allclose(trace_psd(trace, metadata)[0],
+                               trace_psd(expected, metadata)[0],
+                               rtol=1.e-10, atol=0)
+
+    def test_traces_psd_inventory_modified(self):
+        """tests that responses are not cached across calls, i.e. changes
+        to the inventory are taken into account
+        """
+        dataroot = join(dirname(__file__), 'data')
+        stream = read(join(dataroot, 'GE.FLT1..HH?.mseed'))
+        metadata = read_inventory(join(dataroot, 'GE.FLT1.xml'))
+        assert np.isfinite(traces_psd(stream, metadata, [1, 5])).all()
+        for net in metadata:
+            for sta in net:
+                for cha in sta:
+                    cha.response = None
+        with self.assertRaises(ValueError):
+            traces_psd(stream, metadata, [1, 5])
+
+    def test_flat_trace_psd_float32(self):
+        """tests that the single trace psd and features of a flat trace are
+        finite in single precision, and the score the same as in double
+        precision
+        """
+        dataroot = join(dirname(__file__), 'data')
+        metadata = read_inventory(join(dataroot, 'GE.FLT1.xml'))
+        for value in [0, 1000]:
+            trace = read(join(dataroot, 'GE.FLT1..HH?.mseed'))[0]
+            trace.data = np.full(len(trace.data), value, dtype=trace.data.dtype)
+            psds_32 = trace_psd(trace, metadata, dtype=np.float32)[0]
+            assert psds_32.dtype == np.float32
+            assert np.isfinite(psds_32).all()
+            feats_32 = trace_features(trace, metadata, dtype=np.float32)
+            assert np.isfinite(feats_32).all()
+            feats = trace_features(trace, metadata)
+            assert np.allclose(aa_scores(feats.reshape((1, -1))),
+                               aa_scores(feats_32.reshape((1, -1))),
+                               rtol=1.e-5)
+
+    def test_zero_trace_float32(self):
+        """tests that a zero-amplitude trace has finite features and the same
+        score in single and double precision
+        """
+        dataroot = join(dirname(__file__), 'data')
+        trace = read(join(dataroot, 'GE.FLT1..HH?.mseed'))[0]
+        trace.data = np.zeros(len(trace.data), dtype=trace.data.dtype)
+        metadata = read_inventory(join(dataroot, 'GE.FLT1.xml'))
+        feats = traces_features([trace], metadata)
+        feats_32 = traces_features([trace], metadata, dtype=np.float32)
+        assert np.isfinite(feats_32).all()
+        scores = aa_scores(feats)
+        assert np.allclose(scores, aa_scores(feats_32), rtol=1.e-5)
+        assert scores[0] > 0.85
+
+    def test_core_submodules_access(self):
+        """tests that the submodules of sdaas.core are accessible as
+        attributes after `import sdaas.core` (run in a new interpreter, as
+        here they are already imported)
+        """
+        code = ('import sdaas.core\n'
+                'assert sdaas.core.model.aa_scores is sdaas.core.aa_scores\n'
+                'assert sdaas.core.features.traces_features is '
+                'sdaas.core.traces_features\n'
+                'assert callable(sdaas.core.psd)\n'
+                "assert {'model', 'features'} <= set(dir(sdaas.core))")
+        subprocess.run([sys.executable, '-c', code], check=True,
+                       cwd=join(dirname(__file__), '..'))
+
+    def test_aa_scores_nan_inf(self):
+        """tests that only NaN features are not scored (infinite features
+        are scored as very large or small values)
+        """
+        feats = np.array([-np.inf, np.inf, np.nan, -120.])
+        scores = aa_scores(feats)
+        assert np.isnan(scores[2])
+        assert np.isfinite(scores[[0, 1, 3]]).all()
+        assert np.array_equal(scores[[0, 1]], aa_scores([-1.e10, 1.e10]))
+        assert scores[3] == aa_scores([-120.])[0]
+        # infinite features and no NaN:
+        assert np.array_equal(aa_scores(feats[[0, 1, 3]]), scores[[0, 1, 3]])
+
+    def test_aa_scores_nan_no_check(self):
+        """tests that with check_nan=False NaN features are scored as the
+        model does (the default model, without scikit-learn: NaN)
+        """
+        if find_spec('sklearn') is None:
+            scores = aa_scores([np.nan, -120.], check_nan=False)
+            assert np.isnan(scores[0]) and np.isfinite(scores[1])
+
+    @unittest.skipIf(find_spec('sklearn') is None, 'scikit-learn not installed')
+    def test_aa_scores_nan_no_check_sklearn(self):
+        """tests that with check_nan=False the fast scoring paths score NaN
+        features as `model.score_samples`
+        """
+        from sklearn.ensemble import IsolationForest
+        model_module = import_module('sdaas.core.model')
+        rng = np.random.default_rng(0)
+        for n_features in [1, 2]:  # 1: scores lookup table, 2: trees
+            model = IsolationForest(n_estimators=20, random_state=11)
+            model.fit(rng.normal(-130, 10, (1000, n_features)))
+            model_module._setup_fast_scoring(model)
+            feats = rng.normal(-130, 20, (100, n_features))
+            feats[::7, 0] = np.nan
+            try:
+                expected = -model.score_samples(feats)
+            except ValueError:  # old sklearn (NaN not supported)
+                with self.assertRaises(ValueError):
+                    aa_scores(feats, model, check_nan=False)
+                continue
+            assert np.allclose(aa_scores(feats, model, check_nan=False),
+                               expected, rtol=1.e-12, atol=0)
+
+    def test_iter_streams_idfeatures(self):
+        """tests that the features computed in chunks are the same as those
+        computed at once
+        """
+        dataroot = join(dirname(__file__), 'data')
+        streams = [read(join(dataroot, 'GE.FLT1..HH?.mseed'))] * 3
+        metadata = read_inventory(join(dataroot, 'GE.FLT1.xml'))
+        ids, feats = streams_idfeatures(streams, metadata)
+        for chunk_size in [1, 2, 4, 100]:
+            chunks = list(iter_streams_idfeatures(streams, metadata,
+                                                  chunk_size=chunk_size))
+            assert all(len(_[0]) <= chunk_size for _ in chunks)
+            assert [i for _ in chunks for i in _[0]] == ids
+            assert np.array_equal(np.concatenate([_[1] for _ in chunks]),
+                                  feats)
+        assert not list(iter_streams_idfeatures([], metadata))
+        # test scores:
+        ids, scores = streams_idscores(streams, metadata)
+        chunks = list(iter_streams_idscores(streams, metadata, chunk_size=4))
+        assert [i for _ in chunks for i in _[0]] == ids
+        assert np.array_equal(np.concatenate([_[1] for _ in chunks]), scores)
+
+    def test_scores_n_jobs(self):
+        """tests that the scores functions forward n_jobs to aa_scores"""
+        dataroot = join(dirname(__file__), 'data')
+        stream = read(join(dataroot, 'GE.FLT1..HH?.mseed'))
+        metadata = read_inventory(join(dataroot, 'GE.FLT1.xml'))
+        for n_jobs in [1, 2]:
+            with patch('sdaas.core.model.aa_scores',
+                       side_effect=aa_scores) as mock_aa_scores:
+                streams_idscores([stream], metadata, n_jobs=n_jobs)
+                list(iter_streams_idscores([stream], metadata, n_jobs=n_jobs))
+                streams_scores([stream], metadata, n_jobs=n_jobs)
+                traces_idscores(stream, metadata, n_jobs=n_jobs)
+                traces_scores(stream, metadata, n_jobs=n_jobs)
+                assert mock_aa_scores.call_count == 5
+                for call in mock_aa_scores.call_args_list:
+                    assert call[1]['n_jobs'] == n_jobs
+
+    def test_featappend(self):
+        """tests featappend and featappend_many return new writable arrays"""
+        feats = np.array([[1.], [2.]])
+        for ret in [featappend(None, []), featappend_many([]),
+                    featappend_many([None, np.empty((0, 1))])]:
+            assert ret.shape == (0, 1)
+            ret.resize((1, 1), refcheck=False)  # must not raise
+            ret[0] = 1.
+        # the shared empty array is not modified:
+        assert featappend_many([]).shape == (0, 1)
+        ret = featappend(feats, None)
+        assert np.array_equal(ret, feats) and ret is not feats
+        ret = featappend_many([feats, None, feats[:1]])
+        assert np.array_equal(ret, [[1.], [2.], [1.]])
+
+    def test_traces_ids(self):
+        """tests the traces ids as arrays are consistent with the default ids
+        """
+        dataroot = join(dirname(__file__), 'data')
+        stream = read(join(dataroot, 'GE.FLT1..HH?.mseed'))
+        metadata = read_inventory(join(dataroot, 'GE.FLT1.xml'))
+        ids, _ = streams_idfeatures([stream], metadata)
+        soa_ids = traces_ids(stream)
+        assert soa_ids.starts.dtype == soa_ids.ends.dtype == 'datetime64[ns]'
+        assert soa_ids.seed_ids.tolist() == [_[0] for _ in ids]
+        assert soa_ids.starts.astype('datetime64[us]').tolist() == \
+            [_[1] for _ in ids]
+        assert soa_ids.ends.astype('datetime64[us]').tolist() == \
+            [_[2] for _ in ids]
+        assert all(len(_) == 0 for _ in traces_ids([]))
+
 
 class obspyPSD:
     """container for the old functions used in the paper
@@ -6,14 +6,22 @@ Created on 22 Jun 2020
 @author: Riccardo Z. <rizac@gfz-potsdam.de>
 """
 import unittest
+import time
 from datetime import datetime
 import re
-from os.path import join, dirname
+from os import listdir, stat, umask
+from os.path import join, dirname, isfile
+from tempfile import TemporaryDirectory
 from unittest.mock import patch
-from io import StringIO
+from io import StringIO, BytesIO
+from concurrent.futures import ThreadPoolExecutor
 
-from sdaas.run import process, is_threshold_set
+import numpy as np
+
+from sdaas.run import process, is_threshold_set, download_all
 from sdaas.cli.utils import ansi_colors_escape_codes
+from sdaas.cli.cache import FeaturesCache
+from sdaas.cli import fdsn
 
 
 def check_output(output, threshold=-1., sep=None, expected_rows=None):
@@ -158,6 +166,67 @@ class Test(unittest.TestCase):
                     captured = self.stdout
                     check_output(captured, th, sep, expected_rows=1)
 
+    def test_run_from_data_dir_cache(self):
+        """test scores computed with and without features cache are the same"""
+        process(join(self.datadir, 'testdir1'))
+        expected = self.stdout
+        with TemporaryDirectory() as tmpdir:
+            cache = join(tmpdir, 'cache')
+            for _ in range(2):  # 1st: compute and save features. 2nd: load them
+                process(join(self.datadir, 'testdir1'), cache=cache)
+                assert isfile(cache + '.npz')
+                assert self.stdout == expected
+            # no temporary file left:
+            assert listdir(tmpdir) == ['cache.npz']
+            # file mode as set by open() (not mkstemp's 0o600):
+            mask = umask(0)
+            umask(mask)
+            assert stat(cache + '.npz').st_mode & 0o777 == 0o666 & ~mask
+            assert len(FeaturesCache(cache)._data) > 0
+            # cache with different features periods (but same number of
+            # features), or without features periods, is discarded:
+            with np.load(cache + '.npz') as npz:
+                keys, values, features = \
+                    npz['keys'], npz['values'], npz['features']
+            np.savez_compressed(cache + '.npz', keys=keys, values=values,
+                                features=features * 2)
+            assert FeaturesCache(cache)._data == {}
+            np.savez_compressed(cache + '.npz', keys=keys, values=values)
+            assert FeaturesCache(cache)._data == {}
+
+    def test_download_all(self):
+        """test parallel download of urls (mocked, no internet needed)"""
+        def download_side_effect(url, timeout=None):
+            if url.endswith('error'):
+                raise ValueError('error')
+            with open(join(self.datadir, 'trace_GE.APE.mseed'), 'rb') as fpt:
+                return BytesIO(fpt.read())
+
+        with patch('sdaas.run.download', side_effect=download_side_effect):
+            for num in [2, 10]:  # test sequential and parallel download
+                paths = [f'http://url{i}' for i in range(num)] + \
+                        ['http://error', join(self.datadir, 'GE.FLT1.xml')]
+                results = list(download_all(paths))
+                assert [_[0] for _ in results] == paths
+                assert all(isinstance(_[1], BytesIO) for _ in results[:-2])
+                assert isinstance(results[-2][1], ValueError)
+                assert results[-1][1] == paths[-1]
+
+    def test_get_session_threads(self):
+        """test that the HTTP session is created once from concurrent threads"""
+        def create_session_side_effect():
+            time.sleep(0.05)  # let the other threads call get_session
+            return object()
+
+        with patch.object(fdsn, '_SESSION', None):
+            with patch('sdaas.cli.fdsn._create_session',
+                       side_effect=create_session_side_effect) as mock_create:
+                with ThreadPoolExecutor(max_workers=8) as executor:
+                    sessions = list(executor.map(lambda _: fdsn.get_session(),
+                                                 range(8)))
+                assert mock_create.call_count == 1
+                assert all(_ is sessions[0] for _ in sessions)
+
     def test_run_from_data_dir_bad_inventory(self):
 
         # wrong metadata: